@@ -1,242 +1,571 @@
 '''Админ-панель для управления пользователями, ролями и фракциями'''
-import json
 import os
-import hashlib
-from datetime import datetime, date
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
-
-def verify_admin(user_id: int, conn) -> dict:
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT id, username, admin_role FROM users WHERE id = %s AND admin_role IS NOT NULL", (user_id,))
-    admin = cur.fetchone()
-    cur.close()
-    return dict(admin) if admin else None
-
-def verify_admin_code(code: str, conn) -> bool:
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM admin_codes WHERE code = %s AND valid_date >= %s", (code, date.today()))
-    result = cur.fetchone()
-    cur.close()
-    return result is not None
+from datetime import datetime, date, timedelta
+from runtime import (
+    FACTION_COUNTS_UPDATE, LEADERBOARD_COUNTS_UPSERT, FrozenHeaders, HTTPError, Router, TTLCache, cacheable_json_response,
+    cached_response, decode_cursor, dumps, encode_cursor, experience_ledger, invalidation_feed, json_response, page_limit,
+    psycopg, publish_invalidation, publish_response_change, refresh_caches, resolve_session, response_cache
+)
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Id, X-Admin-Code'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
+ADMIN_AUTH_CACHE_TTL = float(os.environ.get('ADMIN_AUTH_CACHE_TTL', '60'))
+ADMIN_AUTH_CACHE_SIZE = int(os.environ.get('ADMIN_AUTH_CACHE_SIZE', '500'))
+ROOT_ADMIN_USERNAME = 'TOURIST_WAGNERA'
+REQUIRE_SESSION_TOKEN = os.environ.get('REQUIRE_SESSION_TOKEN') == '1'
+BULK_LIMIT = 1000
+XP_GRANT_LIMIT = 10000
+XP_REASON_MAX_LENGTH = 50
+BULK_USER_UPDATES = {
+    'bulk-ban': ('is_banned = TRUE', None),
+    'bulk-mute': ('is_muted = TRUE', None),
+    'bulk-update-status': ('status = %s', 'status'),
+    'bulk-assign-faction': ('faction_id = %s', 'factionId'),
+}
+USERS_PAGE_SIZE = 50
+USERS_MAX_PAGE_SIZE = 200
+# Строк в одном ответе выгрузки: больше не помещается в лимит размера ответа функции; дальше — по X-Next-Cursor
+USERS_EXPORT_PAGE_SIZE = 10000
+ROSTER_PAGE_SIZE = 50
+ROSTER_MAX_PAGE_SIZE = 200
+USER_SORTS = {'created': 'u.created_at', 'username': 'u.username', 'experience': 'u.experience'}
+USER_EXPORT_COLUMNS = ['id', 'username', 'admin_role', 'status', 'rank_level', 'experience', 'is_banned', 'is_muted', 'faction_name', 'created_at']
+EXPORT_HEADERS = {
+    'csv': FrozenHeaders({
+        'Content-Type': 'text/csv; charset=utf-8',
+        'Content-Disposition': 'attachment; filename="users.csv"',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Next-Cursor'
+    }),
+    'ndjson': FrozenHeaders({
+        'Content-Type': 'application/x-ndjson; charset=utf-8',
+        'Content-Disposition': 'attachment; filename="users.ndjson"',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Next-Cursor'
+    }),
+}
+
+admin_auth_cache = TTLCache(ADMIN_AUTH_CACHE_SIZE, ADMIN_AUTH_CACHE_TTL)
+invalidation_feed.subscribe('admin-code', lambda code: admin_auth_cache.invalidate_where(lambda key, _: key[1] == code))
+
+def verify_admin(req, user_id: int, code: str) -> dict:
+    '''Проверяет администратора и его код одним запросом; успешный результат кэшируется до конца дня действия кода'''
+    key = (user_id, code or '')
+    admin = admin_auth_cache.get(key)
+    if admin is not None:
+        return admin
+
+    req.cur.execute("""
+        SELECT u.id, u.username, u.admin_role,
+               (SELECT c.valid_date FROM admin_codes c WHERE c.code = %s AND c.valid_date >= %s) as code_valid_until
+        FROM users u
+        WHERE u.id = %s AND u.admin_role IS NOT NULL
+    """, (code, date.today(), user_id))
+    row = req.cur.fetchone()
+    if not row:
+        return None
+
+    admin = dict(row)
+    valid_until = admin.pop('code_valid_until')
+    admin['code_valid'] = admin['username'] == ROOT_ADMIN_USERNAME or valid_until is not None
+    if admin['code_valid'] and req.may_cache:
+        ttl = ADMIN_AUTH_CACHE_TTL
+        if valid_until is not None:
+            expires_at = datetime.combine(valid_until + timedelta(days=1), datetime.min.time())
+            ttl = min(ttl, (expires_at - datetime.now()).total_seconds())
+        admin_auth_cache.set(key, admin, ttl)
+    return admin
+
+def authorize(req):
+    '''Проверка прав администратора перед любым непубличным маршрутом. Администратор берётся из токена сессии;
+    X-Admin-Id без токена принимается, только пока REQUIRE_SESSION_TOKEN выключен'''
+    refresh_caches(req)
+    token = req.header('X-User-Token')
+    if token:
+        user = resolve_session(req, token)
+        if not user:
+            raise HTTPError(401, 'Invalid or expired session')
+        admin_id = user['id']
+    elif REQUIRE_SESSION_TOKEN:
+        raise HTTPError(401, 'Session token required')
+    else:
+        try:
+            admin_id = int(req.header('X-Admin-Id'))
+        except (TypeError, ValueError):
+            raise HTTPError(401, 'Admin ID required')
+
+    admin = verify_admin(req, admin_id, req.header('X-Admin-Code'))
+    if not admin:
+        raise HTTPError(403, 'Not authorized')
+    # Проверка админ-кода (кроме главного админа TOURIST_WAGNERA)
+    if not admin['code_valid']:
+        raise HTTPError(403, 'Invalid or expired admin code')
+    req.user = admin
+
+router = Router('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-User-Token, X-Admin-Id, X-Admin-Code, If-None-Match', before=authorize)
+
+def body_user_id(req) -> int:
+    '''id пользователя из тела; проверяется до любых записей, в том числе в журнал инвалидаций'''
     try:
-        conn = get_db_connection()
-        body = json.loads(event.get('body', '{}')) if event.get('body') else {}
-        headers = event.get('headers', {})
-        path = event.get('queryStringParameters', {}).get('action', '')
-        
-        admin_id = headers.get('x-admin-id') or headers.get('X-Admin-Id')
-        admin_code = headers.get('x-admin-code') or headers.get('X-Admin-Code')
-        
-        # Проверка прав администратора
-        if not admin_id:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Admin ID required'}),
-                'isBase64Encoded': False
-            }
-        
-        admin = verify_admin(int(admin_id), conn)
-        if not admin:
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Not authorized'}),
-                'isBase64Encoded': False
-            }
-        
-        # Проверка админ-кода (кроме главного админа TOURIST_WAGNERA)
-        if admin['username'] != 'TOURIST_WAGNERA':
-            if not admin_code or not verify_admin_code(admin_code, conn):
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid or expired admin code'}),
-                    'isBase64Encoded': False
-                }
-        
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Получение всех пользователей
-        if path == 'users' and method == 'GET':
-            cur.execute("""
-                SELECT u.id, u.username, u.admin_role, u.status, u.rank_level, 
-                       u.is_banned, u.is_muted, f.name as faction_name
-                FROM users u
-                LEFT JOIN factions f ON u.faction_id = f.id
-                ORDER BY u.created_at DESC
-            """)
-            users = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'users': [dict(u) for u in users]}),
-                'isBase64Encoded': False
-            }
-        
-        # Бан пользователя
-        elif path == 'ban' and method == 'POST':
-            user_id = body.get('userId')
-            cur.execute("UPDATE users SET is_banned = TRUE WHERE id = %s", (user_id,))
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'User banned'}),
-                'isBase64Encoded': False
-            }
-        
-        # Мут пользователя
-        elif path == 'mute' and method == 'POST':
-            user_id = body.get('userId')
-            cur.execute("UPDATE users SET is_muted = TRUE WHERE id = %s", (user_id,))
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'User muted'}),
-                'isBase64Encoded': False
-            }
-        
-        # Создание кастомной роли
-        elif path == 'create-role' and method == 'POST':
-            name = body.get('name')
-            description = body.get('description', '')
-            color = body.get('color', '#FFFFFF')
-            
-            cur.execute(
-                "INSERT INTO roles (name, description, color, is_custom, created_by_admin_id) VALUES (%s, %s, %s, TRUE, %s) RETURNING *",
-                (name, description, color, admin_id)
-            )
-            role = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'role': dict(role)}),
-                'isBase64Encoded': False
-            }
-        
-        # Выдача роли пользователю
-        elif path == 'assign-role' and method == 'POST':
-            user_id = body.get('userId')
-            role_id = body.get('roleId')
-            
-            cur.execute(
-                "INSERT INTO user_roles (user_id, role_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                (user_id, role_id)
+        return int(req.body.get('userId'))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'userId required')
+
+def parse_id_list(values) -> list:
+    try:
+        if not isinstance(values, list) or not values or len(values) > BULK_LIMIT:
+            raise ValueError
+        return list(dict.fromkeys(int(v) for v in values))
+    except (TypeError, ValueError):
+        raise HTTPError(400, f'Expected a list of 1..{BULK_LIMIT} ids')
+
+def bulk_results(user_ids: list, updated_ids: set) -> list:
+    return [
+        {'userId': i, 'success': True} if i in updated_ids else {'userId': i, 'success': False, 'error': 'User not found'}
+        for i in user_ids
+    ]
+
+def build_users_filter(params: dict):
+    conditions = []
+    args = []
+    if params.get('factionId'):
+        conditions.append("u.faction_id = %s")
+        args.append(int(params['factionId']))
+    if params.get('adminRole'):
+        conditions.append("u.admin_role = %s")
+        args.append(params['adminRole'])
+    for param, column in (('isBanned', 'u.is_banned'), ('isMuted', 'u.is_muted')):
+        if params.get(param) in ('true', '1'):
+            conditions.append(f"{column} = TRUE")
+        elif params.get(param) in ('false', '0'):
+            conditions.append(f"{column} = FALSE")
+    if params.get('usernamePrefix'):
+        prefix = params['usernamePrefix'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("u.username LIKE %s")
+        args.append(prefix + '%')
+    return conditions, args
+
+def export_users(req, conditions: list, args: list, export_format: str) -> dict:
+    '''Выгружает до USERS_EXPORT_PAGE_SIZE пользователей по возрастанию id; курсор следующей страницы —
+    в заголовке X-Next-Cursor, его передают обратно в cursor'''
+    import csv
+    import io
+
+    cursor = decode_cursor(req.params.get('cursor'), 2)
+    if cursor:
+        if cursor[0] != 'export':
+            raise HTTPError(400, 'Cursor belongs to another sort order')
+        conditions = conditions + ["u.id > %s"]
+        args = args + [cursor[1]]
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    req.cur.execute(f"""
+        SELECT u.id, u.username, u.admin_role, u.status, u.rank_level, u.experience,
+               u.is_banned, u.is_muted, f.name as faction_name, u.created_at
+        FROM users u
+        LEFT JOIN factions f ON u.faction_id = f.id
+        {where_sql}
+        ORDER BY u.id
+        LIMIT %s
+    """, args + [USERS_EXPORT_PAGE_SIZE + 1])
+    rows = req.cur.fetchall()
+
+    headers = EXPORT_HEADERS[export_format]
+    if len(rows) > USERS_EXPORT_PAGE_SIZE:
+        rows = rows[:USERS_EXPORT_PAGE_SIZE]
+        headers = dict(headers, **{'X-Next-Cursor': encode_cursor('export', rows[-1]['id'])})
+
+    out = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(USER_EXPORT_COLUMNS)
+        for row in rows:
+            row['created_at'] = row['created_at'].isoformat()
+            writer.writerow([row[c] for c in USER_EXPORT_COLUMNS])
+    else:
+        for row in rows:
+            out.write(dumps(row))
+            out.write('\n')
+    return {'statusCode': 200, 'headers': headers, 'body': out.getvalue(), 'isBase64Encoded': False}
+
+# Справочник пользователей: фильтры, сортировка, keyset-пагинация и выгрузка
+@router.route('GET', 'users', replica=True)
+def users(req):
+    conditions, args = build_users_filter(req.params)
+
+    export_format = req.params.get('export')
+    if export_format in EXPORT_HEADERS:
+        return export_users(req, conditions, args, export_format)
+
+    sort = req.params.get('sort') if req.params.get('sort') in USER_SORTS else 'created'
+    sort_column = USER_SORTS[sort]
+    direction = 'ASC' if req.params.get('order') == 'asc' else 'DESC'
+    sort_key = f'{sort}:{direction.lower()}'
+    limit = page_limit(req.params, USERS_PAGE_SIZE, USERS_MAX_PAGE_SIZE)
+
+    cursor = decode_cursor(req.params.get('cursor'), 3)
+    if cursor:
+        if cursor[0] != sort_key:
+            raise HTTPError(400, 'Cursor belongs to another sort order')
+        conditions.append(f"({sort_column}, u.id) {'<' if direction == 'DESC' else '>'} (%s, %s)")
+        args.extend(cursor[1:])
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    args.append(limit + 1)
+
+    req.cur.execute(f"""
+        SELECT u.id, u.username, u.admin_role, u.status, u.rank_level, u.experience,
+               u.is_banned, u.is_muted, u.created_at, f.name as faction_name
+        FROM users u
+        LEFT JOIN factions f ON u.faction_id = f.id
+        {where_sql}
+        ORDER BY {sort_column} {direction}, u.id {direction}
+        LIMIT %s
+    """, args)
+    rows = req.cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(sort_key, last[sort_column.split('.')[1]], last['id'])
+    return json_response({'users': rows[:limit], 'nextCursor': next_cursor})
+
+def ban_users(cur, user_ids: list) -> set:
+    '''Банит пользователей и учитывает впервые забаненных в счётчике banned_count их фракций'''
+    cur.execute(f"""
+        WITH old AS (
+            SELECT id, faction_id, COALESCE(is_banned, FALSE) as was_banned FROM users WHERE id = ANY(%s) FOR UPDATE
+        ), banned AS (
+            UPDATE users u SET is_banned = TRUE
+            FROM old
+            WHERE u.id = old.id
+            RETURNING u.id, old.faction_id, old.was_banned
+        ), member_moves AS (
+            SELECT faction_id, 0 as members, 0 as admins, 1 as banned FROM banned WHERE NOT was_banned
+        ), members_counted AS (
+            {FACTION_COUNTS_UPDATE}
+        )
+        SELECT id, (SELECT COUNT(*) FROM members_counted) as factions_changed FROM banned
+    """, (list(user_ids),))
+    rows = cur.fetchall()
+    if any(r['factions_changed'] for r in rows):
+        publish_response_change(cur, 'factions')
+    return {r['id'] for r in rows}
+
+def move_users_to_faction(cur, user_ids: list, faction_id) -> set:
+    '''Меняет фракцию пользователей и переносит их между счётчиками состава фракций и таблиц лидеров'''
+    cur.execute(f"""
+        WITH old AS (
+            SELECT id, faction_id, experience, admin_role, is_banned FROM users WHERE id = ANY(%s) FOR UPDATE
+        ), moved AS (
+            UPDATE users u SET faction_id = %s
+            FROM old
+            WHERE u.id = old.id
+            RETURNING u.id, old.faction_id as old_faction_id, u.faction_id, u.experience,
+                      (old.admin_role IS NOT NULL)::int as admins, COALESCE(old.is_banned, FALSE)::int as banned
+        ), member_moves AS (
+            SELECT x.faction_id, x.delta as members, x.delta * m.admins as admins, x.delta * m.banned as banned
+            FROM moved m
+            CROSS JOIN LATERAL (VALUES (m.old_faction_id, -1), (m.faction_id, 1)) x(faction_id, delta)
+            WHERE m.old_faction_id IS DISTINCT FROM m.faction_id
+        ), members_counted AS (
+            {FACTION_COUNTS_UPDATE}
+        ), moves AS (
+            SELECT x.faction_id, m.experience, x.delta
+            FROM moved m
+            CROSS JOIN LATERAL (VALUES (m.old_faction_id, -1), (m.faction_id, 1)) x(faction_id, delta)
+            WHERE m.old_faction_id IS DISTINCT FROM m.faction_id
+        ), counted AS (
+            {LEADERBOARD_COUNTS_UPSERT}
+        )
+        SELECT id, (SELECT COUNT(*) FROM members_counted) as factions_changed FROM moved
+    """, (list(user_ids), faction_id))
+    rows = cur.fetchall()
+    if any(r['factions_changed'] for r in rows):
+        publish_response_change(cur, 'factions')
+    return {r['id'] for r in rows}
+
+# Бан пользователя
+@router.route('POST', 'ban')
+def ban(req):
+    user_id = body_user_id(req)
+    ban_users(req.cur, [user_id])
+    req.cur.execute("UPDATE sessions SET revoked_at = CURRENT_TIMESTAMP WHERE user_id = %s AND revoked_at IS NULL", (user_id,))
+    publish_invalidation(req.cur, 'profile', [user_id])
+    publish_invalidation(req.cur, 'session-user', [user_id])
+    req.conn.commit()
+    return json_response({'success': True, 'message': 'User banned'})
+
+# Мут пользователя
+@router.route('POST', 'mute')
+def mute(req):
+    user_id = body_user_id(req)
+    req.cur.execute("UPDATE users SET is_muted = TRUE WHERE id = %s", (user_id,))
+    publish_invalidation(req.cur, 'session-user', [user_id])
+    req.conn.commit()
+    return json_response({'success': True, 'message': 'User muted'})
+
+# Массовые изменения пользователей (бан, мут, статус, фракция) одним UPDATE
+def bulk_update_users(req):
+    set_sql, value_key = BULK_USER_UPDATES[req.action]
+    user_ids = parse_id_list(req.body.get('userIds'))
+
+    if req.action == 'bulk-assign-faction':
+        updated_ids = move_users_to_faction(req.cur, user_ids, req.body.get(value_key))
+    elif req.action == 'bulk-ban':
+        updated_ids = ban_users(req.cur, user_ids)
+    else:
+        params = (req.body.get(value_key), user_ids) if value_key else (user_ids,)
+        req.cur.execute(f"UPDATE users SET {set_sql} WHERE id = ANY(%s) RETURNING id", params)
+        updated_ids = {r['id'] for r in req.cur.fetchall()}
+
+    if updated_ids:
+        if req.action == 'bulk-ban':
+            req.cur.execute(
+                "UPDATE sessions SET revoked_at = CURRENT_TIMESTAMP WHERE user_id = ANY(%s) AND revoked_at IS NULL",
+                (list(updated_ids),)
             )
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Role assigned'}),
-                'isBase64Encoded': False
-            }
-        
-        # Получение всех ролей
-        elif path == 'roles' and method == 'GET':
-            cur.execute("SELECT * FROM roles ORDER BY is_custom, name")
-            roles = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'roles': [dict(r) for r in roles]}),
-                'isBase64Encoded': False
-            }
-        
-        # Получение всех фракций
-        elif path == 'factions' and method == 'GET':
-            cur.execute("""
-                SELECT f.*, u.username as general_name 
-                FROM factions f
-                LEFT JOIN users u ON f.general_user_id = u.id
-                ORDER BY 
-                    CASE f.type 
-                        WHEN 'открытая' THEN 1 
-                        WHEN 'закрытая' THEN 2 
-                        WHEN 'криминальная' THEN 3 
-                    END, f.name
-            """)
-            factions = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'factions': [dict(f) for f in factions]}),
-                'isBase64Encoded': False
-            }
-        
-        # Обновление статуса пользователя
-        elif path == 'update-status' and method == 'PUT':
-            user_id = body.get('userId')
-            status = body.get('status')
-            
-            cur.execute("UPDATE users SET status = %s WHERE id = %s", (status, user_id))
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Status updated'}),
-                'isBase64Encoded': False
-            }
-        
-        # Назначить пользователя в фракцию
-        elif path == 'assign-faction' and method == 'POST':
-            user_id = body.get('userId')
-            faction_id = body.get('factionId')
-            
-            cur.execute("UPDATE users SET faction_id = %s WHERE id = %s", (faction_id, user_id))
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Faction assigned'}),
-                'isBase64Encoded': False
-            }
-        
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Endpoint not found'}),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        if req.action in ('bulk-ban', 'bulk-mute'):
+            publish_invalidation(req.cur, 'session-user', updated_ids)
+        publish_invalidation(req.cur, 'profile', updated_ids)
+    req.conn.commit()
+
+    return json_response({
+        'success': True,
+        'updated': len(updated_ids),
+        'results': bulk_results(user_ids, updated_ids)
+    })
+
+for bulk_action in BULK_USER_UPDATES:
+    router.route('POST', bulk_action)(bulk_update_users)
+
+# Массовая выдача ролей по парам (userId, roleId)
+@router.route('POST', 'bulk-assign-role')
+def bulk_assign_role(req):
+    try:
+        pairs = list(dict.fromkeys((int(a['userId']), int(a['roleId'])) for a in req.body.get('assignments')))
+        if not pairs or len(pairs) > BULK_LIMIT:
+            raise ValueError(f'expected 1..{BULK_LIMIT} assignments')
+    except (TypeError, ValueError, KeyError) as e:
+        raise HTTPError(400, f'Invalid assignments: {e}')
+
+    req.cur.execute("""
+        WITH pairs AS (
+            SELECT * FROM unnest(%s::int[], %s::int[]) AS p(user_id, role_id)
+        ), valid AS (
+            SELECT p.user_id, p.role_id FROM pairs p
+            JOIN users u ON u.id = p.user_id
+            JOIN roles r ON r.id = p.role_id
+        ), inserted AS (
+            INSERT INTO user_roles (user_id, role_id)
+            SELECT user_id, role_id FROM valid
+            ON CONFLICT DO NOTHING
+            RETURNING user_id, role_id
+        )
+        SELECT v.user_id, v.role_id, i.user_id IS NOT NULL as inserted
+        FROM valid v
+        LEFT JOIN inserted i ON i.user_id = v.user_id AND i.role_id = v.role_id
+    """, ([p[0] for p in pairs], [p[1] for p in pairs]))
+    outcome = {(r['user_id'], r['role_id']): r['inserted'] for r in req.cur.fetchall()}
+
+    changed_users = {p[0] for p, inserted in outcome.items() if inserted}
+    if changed_users:
+        publish_invalidation(req.cur, 'profile', changed_users)
+    req.conn.commit()
+
+    results = []
+    for user_id, role_id in pairs:
+        item = {'userId': user_id, 'roleId': role_id, 'success': (user_id, role_id) in outcome}
+        if not item['success']:
+            item['error'] = 'User or role not found'
+        elif not outcome[(user_id, role_id)]:
+            item['alreadyAssigned'] = True
+        results.append(item)
+
+    return json_response({'success': True, 'assigned': sum(outcome.values()), 'results': results})
+
+# Смена админ-кода: новый код вступает в силу, остальные действующие коды отзываются
+@router.route('POST', 'rotate-code')
+def rotate_code(req):
+    if req.user['admin_role'] != 'старший администратор':
+        raise HTTPError(403, 'Only senior admins can rotate codes')
+
+    code = req.body.get('code')
+    if not isinstance(code, str) or not code.strip():
+        raise HTTPError(400, 'code required')
+    today = date.today()
+    # Новый код должен действовать: с датой в прошлом ротация вывела бы из строя все коды сразу
+    try:
+        valid_date = date.fromisoformat(req.body.get('validDate') or today.isoformat())
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'validDate must be a YYYY-MM-DD date')
+    if valid_date < today:
+        raise HTTPError(400, 'validDate must be today or later')
+
+    try:
+        req.cur.execute(
+            "INSERT INTO admin_codes (code, valid_date) VALUES (%s, %s) RETURNING valid_date",
+            (code, valid_date)
+        )
+    except psycopg().IntegrityError:
+        req.conn.rollback()
+        raise HTTPError(409, 'Code already exists')
+    new_code = req.cur.fetchone()
+
+    req.cur.execute(
+        "UPDATE admin_codes SET valid_date = %s WHERE code <> %s AND valid_date >= %s RETURNING code",
+        (today - timedelta(days=1), code, today)
+    )
+    retired = [r['code'] for r in req.cur.fetchall()]
+    if retired:
+        publish_invalidation(req.cur, 'admin-code', retired)
+    req.conn.commit()
+    admin_auth_cache.invalidate_where(lambda key, _: key[1] in retired)
+
+    return json_response({'success': True, 'validDate': new_code['valid_date'], 'retired': len(retired)})
+
+# Статистика кэша авторизации
+@router.route('GET', 'auth-stats')
+def auth_stats(req):
+    stats = admin_auth_cache.stats
+    lookups = stats['hits'] + stats['misses']
+    return json_response({'authCache': stats, 'hitRate': stats['hits'] / lookups if lookups else None})
+
+# Создание кастомной роли
+@router.route('POST', 'create-role')
+def create_role(req):
+    name = req.body.get('name')
+    description = req.body.get('description', '')
+    color = req.body.get('color', '#FFFFFF')
+
+    req.cur.execute(
+        "INSERT INTO roles (name, description, color, is_custom, created_by_admin_id) VALUES (%s, %s, %s, TRUE, %s) RETURNING *",
+        (name, description, color, req.user['id'])
+    )
+    role = req.cur.fetchone()
+    publish_response_change(req.cur, 'roles')
+    req.conn.commit()
+    return json_response({'success': True, 'role': role})
+
+# Выдача роли пользователю
+@router.route('POST', 'assign-role')
+def assign_role(req):
+    user_id = body_user_id(req)
+    role_id = req.body.get('roleId')
+
+    req.cur.execute(
+        "INSERT INTO user_roles (user_id, role_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+        (user_id, role_id)
+    )
+    publish_invalidation(req.cur, 'profile', [user_id])
+    req.conn.commit()
+    return json_response({'success': True, 'message': 'Role assigned'})
+
+# Получение всех ролей
+@router.route('GET', 'roles', replica=True)
+def roles(req):
+    cached = response_cache.get('roles', 'roles')
+    if cached:
+        return cached_response(req, *cached)
+
+    req.cur.execute("SELECT * FROM roles ORDER BY is_custom, name")
+    return cacheable_json_response(req, 'roles', 'roles', {'roles': req.cur.fetchall()})
+
+# Получение всех фракций
+@router.route('GET', 'factions', replica=True)
+def factions(req):
+    cached = response_cache.get('factions', 'factions')
+    if cached:
+        return cached_response(req, *cached)
+
+    req.cur.execute("""
+        SELECT f.*, u.username as general_name
+        FROM factions f
+        LEFT JOIN users u ON f.general_user_id = u.id
+        ORDER BY
+            CASE f.type
+                WHEN 'открытая' THEN 1
+                WHEN 'закрытая' THEN 2
+                WHEN 'криминальная' THEN 3
+            END, f.name
+    """)
+    return cacheable_json_response(req, 'factions', 'factions', {'factions': req.cur.fetchall()})
+
+# Состав фракции по убыванию опыта с keyset-пагинацией; счётчики берутся из строки фракции
+@router.route('GET', 'faction-roster', replica=True)
+def faction_roster(req):
+    try:
+        faction_id = int(req.params.get('factionId'))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'factionId required')
+    limit = page_limit(req.params, ROSTER_PAGE_SIZE, ROSTER_MAX_PAGE_SIZE)
+    cursor = decode_cursor(req.params.get('cursor'), 2)
+
+    req.cur.execute(
+        "SELECT id, name, type, color, member_count, admin_count, banned_count FROM factions WHERE id = %s",
+        (faction_id,)
+    )
+    faction = req.cur.fetchone()
+    if not faction:
+        raise HTTPError(404, 'Faction not found')
+
+    conditions = ["u.faction_id = %s"]
+    args = [faction_id]
+    if cursor:
+        conditions.append("(u.experience, u.id) < (%s, %s)")
+        args.extend(cursor)
+    args.append(limit + 1)
+
+    req.cur.execute(f"""
+        SELECT u.id, u.username, u.avatar_url, u.admin_role, u.status, u.rank_level, u.experience,
+               u.is_banned, u.is_muted, u.created_at
+        FROM users u
+        WHERE {' AND '.join(conditions)}
+        ORDER BY u.experience DESC, u.id DESC
+        LIMIT %s
+    """, args)
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['experience'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return json_response({'faction': faction, 'members': rows[:limit], 'nextCursor': next_cursor})
+
+# Обновление статуса пользователя
+@router.route('PUT', 'update-status')
+def update_status(req):
+    user_id = body_user_id(req)
+    status = req.body.get('status')
+
+    req.cur.execute("UPDATE users SET status = %s WHERE id = %s", (status, user_id))
+    publish_invalidation(req.cur, 'profile', [user_id])
+    req.conn.commit()
+    return json_response({'success': True, 'message': 'Status updated'})
+
+# Назначить пользователя в фракцию
+@router.route('POST', 'assign-faction')
+def assign_faction(req):
+    user_id = body_user_id(req)
+    faction_id = req.body.get('factionId')
+
+    move_users_to_faction(req.cur, [user_id], faction_id)
+    publish_invalidation(req.cur, 'profile', [user_id])
+    req.conn.commit()
+    return json_response({'success': True, 'message': 'Faction assigned'})
+
+# Начисление (или списание) опыта администрацией; применяется вместе с остальными начислениями при свёртке
+@router.route('POST', 'grant-experience')
+def grant_experience(req):
+    try:
+        user_id = int(req.body.get('userId'))
+        amount = int(req.body.get('amount'))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'userId and integer amount required')
+    if amount == 0 or abs(amount) > XP_GRANT_LIMIT:
+        raise HTTPError(400, f'amount must be between -{XP_GRANT_LIMIT} and {XP_GRANT_LIMIT} and not zero')
+    reason = (req.body.get('reason') or 'admin').strip()[:XP_REASON_MAX_LENGTH]
+
+    req.cur.execute("SELECT 1 FROM users WHERE id = %s", (user_id,))
+    if not req.cur.fetchone():
+        raise HTTPError(404, 'User not found')
+    experience_ledger.award(req.cur, user_id, amount, reason)
+    req.conn.commit()
+
+    experience_ledger.fold_if_due(req.conn)
+    return json_response({'success': True, 'message': 'Experience granted'})
+
+def handler(event: dict, context) -> dict:
+    return router.dispatch(event)
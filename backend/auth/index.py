@@ -1,14 +1,24 @@
 '''API для авторизации и управления пользователями Russian Town'''
-import json
-import os
 import hashlib
+import os
 import secrets
-from datetime import datetime, timedelta
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from runtime import (
+    FACTION_COUNTS_UPDATE, LEADERBOARD_BUCKET, LEADERBOARD_GLOBAL, SESSION_TTL, HTTPError, Router, TTLCache, cacheable_json_response,
+    cached_response, decode_cursor, encode_cursor, experience_ledger, flood_guard, hash_token, invalidation_feed, json_response,
+    page_limit, psycopg, publish_invalidation, publish_response_change, refresh_caches, resolve_session, response_cache, session_cache
+)
+
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '1000'))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '30'))
+PROFILE_BATCH_LIMIT = 100
+LEADERBOARD_PAGE_SIZE = 100
+# Ограничения частоты: (запросов, за секунд) на адрес, для входа — ещё и на логин
+FLOOD_LIMITS = {'register': (5, 3600), 'login': (10, 300)}
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+router = Router('GET, POST, PUT, OPTIONS', 'Content-Type, X-User-Token', batch=True)
+
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+invalidation_feed.subscribe('profile', lambda key: profile_cache.invalidate(int(key)))
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -16,203 +26,302 @@ def hash_password(password: str) -> str:
 def generate_token() -> str:
     return secrets.token_urlsafe(32)
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Token'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
+def create_session(cur, user_id: int) -> str:
+    token = generate_token()
+    cur.execute("""
+        WITH expired AS (
+            DELETE FROM sessions WHERE user_id = %s AND expires_at <= CURRENT_TIMESTAMP
+        )
+        INSERT INTO sessions (token_hash, user_id, expires_at)
+        VALUES (%s, %s, CURRENT_TIMESTAMP + %s)
+    """, (user_id, hash_token(token), user_id, SESSION_TTL))
+    return token
+
+def load_profiles(req, user_ids: list) -> dict:
+    profiles = {}
+    missing = []
+    for user_id in user_ids:
+        profile = profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+    if not missing:
+        return profiles
+
+    req.cur.execute("""
+        SELECT u.id, u.username, u.admin_role, u.status, u.custom_status,
+               u.rank_level, u.experience, u.avatar_url, u.discord_link,
+               f.name as faction_name, f.color as faction_color,
+               COALESCE((
+                   SELECT json_agg(json_build_object('name', r.name, 'color', r.color) ORDER BY r.name)
+                   FROM user_roles ur
+                   JOIN roles r ON r.id = ur.role_id
+                   WHERE ur.user_id = u.id
+               ), '[]'::json) as roles
+        FROM users u
+        LEFT JOIN factions f ON u.faction_id = f.id
+        WHERE u.id = ANY(%s)
+    """, (missing,))
+
+    for row in req.cur.fetchall():
+        user = dict(row)
+        profile = {'user': user, 'roles': user.pop('roles')}
+        if req.may_cache:
+            profile_cache.set(user['id'], profile)
+        profiles[user['id']] = profile
+    return profiles
+
+# Регистрация; при регистрации можно сразу вступить в открытую фракцию
+@router.route('POST', 'register')
+def register(req):
+    username = req.body.get('username')
+    password = req.body.get('password')
+    faction_id = req.body.get('factionId')
+
+    if not username or not password:
+        raise HTTPError(400, 'Username and password required')
+    flood_guard.admit(req, 'register', FLOOD_LIMITS['register'])
+    if faction_id is not None:
+        req.cur.execute("SELECT type FROM factions WHERE id = %s", (faction_id,))
+        faction = req.cur.fetchone()
+        if not faction:
+            raise HTTPError(404, 'Faction not found')
+        if faction['type'] != 'открытая':
+            raise HTTPError(403, 'Only open factions can be joined on registration')
+
     try:
-        path = event.get('queryStringParameters', {}).get('action', '')
-        body = json.loads(event.get('body', '{}')) if event.get('body') else {}
-        
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Регистрация
-        if path == 'register' and method == 'POST':
-            username = body.get('username')
-            password = body.get('password')
-            
-            if not username or not password:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Username and password required'}),
-                    'isBase64Encoded': False
-                }
-            
-            password_hash = hash_password(password)
-            
-            try:
-                cur.execute(
-                    "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id, username, status, rank_level",
-                    (username, password_hash)
-                )
-                user = cur.fetchone()
-                conn.commit()
-                
-                token = generate_token()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'user': dict(user),
-                        'token': token
-                    }),
-                    'isBase64Encoded': False
-                }
-            except psycopg2.IntegrityError:
-                conn.rollback()
-                return {
-                    'statusCode': 409,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Username already exists'}),
-                    'isBase64Encoded': False
-                }
-        
-        # Вход
-        elif path == 'login' and method == 'POST':
-            username = body.get('username')
-            password = body.get('password')
-            
-            password_hash = hash_password(password)
-            
-            cur.execute(
-                "SELECT id, username, admin_role, status, rank_level, faction_id, avatar_url, custom_status, is_banned FROM users WHERE username = %s AND password_hash = %s",
-                (username, password_hash)
+        req.cur.execute(f"""
+            WITH inserted AS (
+                INSERT INTO users (username, password_hash, faction_id) VALUES (%s, %s, %s)
+                RETURNING id, username, status, rank_level, faction_id
+            ), member_moves AS (
+                SELECT faction_id, 1 as members, 0 as admins, 0 as banned FROM inserted
+            ), members_counted AS (
+                {FACTION_COUNTS_UPDATE}
             )
-            user = cur.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
-            
-            if user['is_banned']:
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Account is banned'}),
-                    'isBase64Encoded': False
-                }
-            
-            token = generate_token()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'user': dict(user),
-                    'token': token
-                }),
-                'isBase64Encoded': False
-            }
-        
-        # Получение профиля
-        elif path == 'profile' and method == 'GET':
-            user_id = event.get('queryStringParameters', {}).get('userId')
-            
-            cur.execute("""
-                SELECT u.id, u.username, u.admin_role, u.status, u.custom_status, 
-                       u.rank_level, u.experience, u.avatar_url, u.discord_link,
-                       f.name as faction_name, f.color as faction_color
-                FROM users u
-                LEFT JOIN factions f ON u.faction_id = f.id
-                WHERE u.id = %s
-            """, (user_id,))
-            
-            user = cur.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'User not found'}),
-                    'isBase64Encoded': False
-                }
-            
-            # Получение ролей пользователя
-            cur.execute("""
-                SELECT r.name, r.color 
-                FROM roles r
-                JOIN user_roles ur ON r.id = ur.role_id
-                WHERE ur.user_id = %s
-            """, (user_id,))
-            roles = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'user': dict(user),
-                    'roles': [dict(r) for r in roles]
-                }),
-                'isBase64Encoded': False
-            }
-        
-        # Обновление профиля
-        elif path == 'update-profile' and method == 'PUT':
-            user_id = body.get('userId')
-            custom_status = body.get('customStatus')
-            avatar_url = body.get('avatarUrl')
-            
-            updates = []
-            params = []
-            
-            if custom_status is not None:
-                updates.append("custom_status = %s")
-                params.append(custom_status)
-            
-            if avatar_url is not None:
-                updates.append("avatar_url = %s")
-                params.append(avatar_url)
-            
-            if updates:
-                params.append(user_id)
-                cur.execute(
-                    f"UPDATE users SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING *",
-                    params
-                )
-                user = cur.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'user': dict(user)}),
-                    'isBase64Encoded': False
-                }
-        
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Endpoint not found'}),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
+            SELECT * FROM inserted
+        """, (username, hash_password(password), faction_id))
+    except psycopg().IntegrityError:
+        req.conn.rollback()
+        raise HTTPError(409, 'Username already exists')
+    user = req.cur.fetchone()
+    if faction_id is not None:
+        publish_response_change(req.cur, 'factions')
+    token = create_session(req.cur, user['id'])
+    req.conn.commit()
+
+    return json_response({'success': True, 'user': user, 'token': token})
+
+# Вход
+@router.route('POST', 'login')
+def login(req):
+    username = req.body.get('username')
+    password = req.body.get('password')
+    flood_guard.admit(req, 'login', FLOOD_LIMITS['login'], keys=[f'username:{str(username)[:100]}'])
+
+    req.cur.execute(
+        "SELECT id, username, admin_role, status, rank_level, faction_id, avatar_url, custom_status, is_banned FROM users WHERE username = %s AND password_hash = %s",
+        (username, hash_password(password))
+    )
+    user = req.cur.fetchone()
+
+    if not user:
+        raise HTTPError(401, 'Invalid credentials')
+    if user['is_banned']:
+        raise HTTPError(403, 'Account is banned')
+
+    token = create_session(req.cur, user['id'])
+    req.conn.commit()
+
+    return json_response({'success': True, 'user': user, 'token': token})
+
+# Проверка токена сессии
+@router.route('GET', 'session')
+def session(req):
+    refresh_caches(req)
+    user = resolve_session(req, req.header('X-User-Token'))
+    if not user:
+        raise HTTPError(401, 'Invalid or expired session')
+    return json_response({'user': user})
+
+# Выход: отзыв токена сессии
+@router.route('POST', 'logout')
+def logout(req):
+    token = req.header('X-User-Token')
+    if token:
+        token_hash = hash_token(token)
+        req.cur.execute(
+            "UPDATE sessions SET revoked_at = CURRENT_TIMESTAMP WHERE token_hash = %s AND revoked_at IS NULL",
+            (token_hash,)
+        )
+        publish_invalidation(req.cur, 'session', [token_hash])
+        req.conn.commit()
+        session_cache.invalidate(token_hash)
+    return json_response({'success': True})
+
+# Получение профиля (одним запросом, роли агрегируются в БД)
+@router.route('GET', 'profile', replica=True)
+def profile(req):
+    try:
+        user_id = int(req.params.get('userId'))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'userId required')
+    refresh_caches(req)
+    found = load_profiles(req, [user_id]).get(user_id)
+    if not found:
+        raise HTTPError(404, 'User not found')
+    return json_response(found)
+
+# Пакетное получение профилей
+@router.route('GET', 'profiles', replica=True)
+def profiles(req):
+    raw_ids = req.params.get('userIds', '')
+    try:
+        user_ids = list(dict.fromkeys(int(i) for i in raw_ids.split(',') if i.strip()))
+    except ValueError:
+        raise HTTPError(400, 'userIds must be a comma-separated list of ids')
+    if len(user_ids) > PROFILE_BATCH_LIMIT:
+        raise HTTPError(400, f'At most {PROFILE_BATCH_LIMIT} userIds per request')
+
+    refresh_caches(req)
+    found = load_profiles(req, user_ids)
+    return json_response({
+        'profiles': [found[i] for i in user_ids if i in found],
+        'missing': [i for i in user_ids if i not in found]
+    })
+
+def experience_standing(cur, faction_id: int, experience: int) -> dict:
+    '''Сколько игроков области опередили данный опыт и сколько его делят — по счётчикам leaderboard_counts'''
+    bucket = experience // LEADERBOARD_BUCKET
+    cur.execute("""
+        SELECT COALESCE((
+                   SELECT SUM(users) FROM leaderboard_counts
+                   WHERE faction_id = %(faction)s AND width = %(width)s AND value > %(bucket)s
+               ), 0) + COALESCE((
+                   SELECT SUM(users) FROM leaderboard_counts
+                   WHERE faction_id = %(faction)s AND width = 1 AND value > %(experience)s AND value < %(next)s
+               ), 0) as ahead,
+               COALESCE((
+                   SELECT users FROM leaderboard_counts
+                   WHERE faction_id = %(faction)s AND width = 1 AND value = %(experience)s
+               ), 0) as tied
+    """, {
+        'faction': faction_id, 'width': LEADERBOARD_BUCKET, 'bucket': bucket,
+        'experience': experience, 'next': (bucket + 1) * LEADERBOARD_BUCKET
+    })
+    return cur.fetchone()
+
+# Таблица лидеров: общая или фракции; места игроков с равным опытом совпадают
+@router.route('GET', 'leaderboard', replica=True)
+def leaderboard(req):
+    try:
+        faction_id = int(req.params.get('factionId') or LEADERBOARD_GLOBAL)
+    except ValueError:
+        raise HTTPError(400, 'Invalid factionId')
+    cache_key = ('leaderboard', tuple(sorted(req.params.items())))
+    refresh_caches(req)
+    experience_ledger.fold_if_due(req.primary)
+    cached = response_cache.get('leaderboard', cache_key)
+    if cached:
+        return cached_response(req, *cached)
+
+    limit = page_limit(req.params, LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE)
+    cursor = decode_cursor(req.params.get('cursor'), 2)
+    conditions = ["u.experience > 0"]
+    query_params = []
+    if faction_id != LEADERBOARD_GLOBAL:
+        conditions.append("u.faction_id = %s")
+        query_params.append(faction_id)
+    if cursor:
+        conditions.append("(u.experience, u.id) < (%s, %s)")
+        query_params.extend(cursor)
+    query_params.append(limit + 1)
+
+    req.cur.execute(f"""
+        SELECT u.id, u.username, u.avatar_url, u.rank_level, u.experience, f.name as faction_name
+        FROM users u
+        LEFT JOIN factions f ON u.faction_id = f.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY u.experience DESC, u.id DESC
+        LIMIT %s
+    """, query_params)
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['experience'], rows[limit - 1]['id']) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    # Страница непрерывна: место следующей группы равного опыта = место предыдущей + её размер;
+    # размер первой группы берётся из счётчиков, потому что она могла начаться на прошлой странице
+    if rows:
+        first = experience_standing(req.cur, faction_id, rows[0]['experience'])
+        position, group, current = first['ahead'] + 1, first['tied'], rows[0]['experience']
+        for row in rows:
+            if row['experience'] != current:
+                position, group, current = position + group, 0, row['experience']
+            row['position'] = position
+            if current != rows[0]['experience']:
+                group += 1
+
+    payload = {'factionId': faction_id, 'entries': rows, 'nextCursor': next_cursor}
+    if req.params.get('userId'):
+        try:
+            me_id = int(req.params['userId'])
+        except ValueError:
+            raise HTTPError(400, 'Invalid userId')
+        req.cur.execute("SELECT id, experience, rank_level, faction_id FROM users WHERE id = %s", (me_id,))
+        me = req.cur.fetchone()
+        if not me:
+            raise HTTPError(404, 'User not found')
+        position = None
+        if faction_id == LEADERBOARD_GLOBAL or me['faction_id'] == faction_id:
+            position = experience_standing(req.cur, faction_id, me['experience'])['ahead'] + 1
+        payload['me'] = {
+            'userId': me['id'], 'experience': me['experience'], 'rankLevel': me['rank_level'], 'position': position
         }
+    return cacheable_json_response(req, 'leaderboard', cache_key, payload)
+
+# Обновление своего профиля: пользователь берётся из токена сессии
+@router.route('PUT', 'update-profile')
+def update_profile(req):
+    refresh_caches(req)
+    session_user = resolve_session(req, req.header('X-User-Token'))
+    if not session_user:
+        raise HTTPError(401, 'Invalid or expired session')
+    user_id = session_user['id']
+    custom_status = req.body.get('customStatus')
+    avatar_url = req.body.get('avatarUrl')
+
+    updates = []
+    params = []
+
+    if custom_status is not None:
+        updates.append("custom_status = %s")
+        params.append(custom_status)
+
+    if avatar_url is not None:
+        updates.append("avatar_url = %s")
+        params.append(avatar_url)
+
+    if not updates:
+        raise HTTPError(400, 'Nothing to update')
+
+    params.append(user_id)
+    req.cur.execute(
+        f"""UPDATE users SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE id = %s
+            RETURNING id, username, admin_role, status, custom_status, rank_level, experience,
+                      faction_id, avatar_url, discord_link, updated_at""",
+        params
+    )
+    user = req.cur.fetchone()
+    publish_invalidation(req.cur, 'profile', [user_id])
+    if avatar_url is not None:
+        # Аватар встроен в кэшированные списки постов, комментариев и таблицу лидеров
+        for scope in ('posts', 'comments', 'leaderboard'):
+            publish_response_change(req.cur, scope)
+    req.conn.commit()
+    profile_cache.invalidate(int(user_id))
+
+    return json_response({'success': True, 'user': user})
+
+def handler(event: dict, context) -> dict:
+    return router.dispatch(event)
@@ -1,157 +1,535 @@
 '''API для форума с постами и комментариями'''
-import json
+import heapq
 import os
-from datetime import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import select
+import threading
+import time
+from itertools import islice
+from runtime import (
+    FrozenHeaders, HTTPError, LikeCounter, Router, cacheable_json_response, cached_response, decode_cursor, dumps,
+    encode_cursor, experience_ledger, flood_guard, json_response, page_limit, psycopg, publish_response_change, refresh_caches,
+    resolve_session, response_cache
+)
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+REQUIRE_SESSION_TOKEN = os.environ.get('REQUIRE_SESSION_TOKEN') == '1'
+POSTS_PAGE_SIZE = 50
+POSTS_MAX_PAGE_SIZE = 100
+POST_EXCERPT_LENGTH = 280
+# Порядок выдачи постов -> столбец keyset-курсора; у каждого порядка свой индекс (столбец DESC, id DESC)
+POST_SORTS = {'new': 'created_at', 'active': 'last_activity_at', 'hot': 'hot_score'}
+# Опыт за активность на форуме; за лайк получает автор поста при свёртке счётчика
+XP_AWARDS = {'post': 10, 'comment': 2, 'like': 1}
+# Ограничения частоты записей: (запросов, за секунд) на автора и на адрес
+FLOOD_LIMITS = {'create-post': (5, 300), 'add-comment': (10, 60)}
+TIMELINE_PAGE_SIZE = 30
+TIMELINE_MAX_PAGE_SIZE = 100
+# Источники ленты: (псевдоним, столбец автора, выборка). Каждый читается по индексу (created_at DESC, id DESC),
+# с автором — по (автор, created_at DESC, id DESC)
+TIMELINE_SOURCES = {
+    'post': ('p', 'user_id', """
+        SELECT 'post' as kind, p.id, p.id as post_id, p.title, LEFT(p.content, %(excerpt)s) as excerpt,
+               p.created_at, p.user_id, u.username, u.avatar_url
+        FROM forum_posts p
+        JOIN users u ON p.user_id = u.id
+    """),
+    'comment': ('c', 'user_id', """
+        SELECT 'comment' as kind, c.id, c.post_id, fp.title, LEFT(c.content, %(excerpt)s) as excerpt,
+               c.created_at, c.user_id, u.username, u.avatar_url
+        FROM forum_comments c
+        JOIN forum_posts fp ON c.post_id = fp.id
+        LEFT JOIN users u ON c.user_id = u.id
+    """),
+    'news': ('n', 'author_id', """
+        SELECT 'news' as kind, n.id, NULL::int as post_id, n.title, LEFT(n.content, %(excerpt)s) as excerpt,
+               n.created_at, n.author_id as user_id, u.username, u.avatar_url
+        FROM news n
+        LEFT JOIN users u ON n.author_id = u.id
+    """),
+}
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2'
+EVENTS_CHANNEL = 'forum_events'
+EVENTS_PAGE_SIZE = 100
+EVENTS_MAX_WAIT = float(os.environ.get('EVENTS_MAX_WAIT', '25'))
+EVENTS_RETRY_MS = 1000
+# После уведомления событие может быть ещё не видно: его обгоняет незакоммиченная транзакция с меньшим tx
+EVENTS_SETTLE_CHECKS = 5
+EVENTS_SETTLE_DELAY = 0.05
+SSE_HEADERS = FrozenHeaders({
+    'Content-Type': 'text/event-stream; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'Access-Control-Allow-Origin': '*'
+})
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
+router = Router('GET, POST, PUT, OPTIONS', 'Content-Type, X-User-Id, X-User-Token, If-None-Match, Last-Event-ID', batch=True)
+
+def resolve_author_id(req) -> int:
+    '''Автор берётся из токена сессии; userId из тела принимается, только пока REQUIRE_SESSION_TOKEN выключен'''
+    token = req.header('X-User-Token')
+    if not token:
+        if REQUIRE_SESSION_TOKEN:
+            raise HTTPError(401, 'Session token required')
+        user_id = req.body.get('userId')
+        try:
+            return int(user_id) if user_id is not None else None
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'userId must be an integer')
+    refresh_caches(req)
+    user = resolve_session(req, token)
+    if not user:
+        raise HTTPError(401, 'Invalid or expired session')
+    return user['id']
+
+def award_like_experience(cur, totals: dict):
+    '''Свёрнутые лайки начисляются авторам постов одной вставкой в буфер опыта'''
+    cur.execute("""
+        INSERT INTO experience_awards (user_id, amount, reason)
+        SELECT p.user_id, t.delta * %s, 'like'
+        FROM unnest(%s::int[], %s::int[]) AS t(id, delta)
+        JOIN forum_posts p ON p.id = t.id
+        WHERE p.user_id IS NOT NULL
+    """, (XP_AWARDS['like'], list(totals), list(totals.values())))
+
+post_likes = LikeCounter('post', response_scope='posts', on_fold=award_like_experience)
+
+def publish_forum_event(cur, kind: str, post_id: int, data: dict):
+    '''Пишет событие в журнал forum_events и будит ожидающих через NOTIFY; уведомление уходит при коммите'''
+    cur.execute("""
+        WITH pruned AS (
+            DELETE FROM forum_events WHERE created_at < CURRENT_TIMESTAMP - INTERVAL '1 day'
+        ), event AS (
+            INSERT INTO forum_events (kind, post_id, data) VALUES (%s, %s, %s) RETURNING id
+        )
+        SELECT pg_notify(%s, id::text) FROM event
+    """, (kind, post_id, dumps(data), EVENTS_CHANNEL))
+
+class EventListener:
+    '''Одно autocommit-соединение контейнера с LISTEN: ожидающие запросы не держат соединения пула
+    и не выполняют запросов, пока не придёт уведомление'''
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.latest_id = 0
+        self.stats = {'connects': 0, 'notifications': 0, 'waits': 0, 'timeouts': 0}
+        self._conn = None
+        self._polling = False
+        self._cond = threading.Condition()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            conn = psycopg().connect(os.environ['DATABASE_URL'])
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN {self.channel}')
+                # События, закоммиченные до LISTEN, уведомлений уже не пришлют
+                cur.execute("SELECT COALESCE(MAX(id), 0) FROM forum_events")
+                self._advance(cur.fetchone()[0])
+            self._conn = conn
+            self.stats['connects'] += 1
+        return self._conn
+
+    def _advance(self, event_id: int):
+        with self._cond:
+            if event_id > self.latest_id:
+                self.latest_id = event_id
+                self._cond.notify_all()
+
+    def _poll(self, timeout: float):
+        conn = self._connection()
+        try:
+            if select.select([conn], [], [], timeout)[0]:
+                conn.poll()
+        except (OSError, psycopg().Error):
+            conn.close()
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            self.stats['notifications'] += 1
+            self._advance(int(notify.payload))
+
+    def wait_for(self, after_id: int, timeout: float) -> bool:
+        '''Ждёт события с id больше after_id; сокет слушает один поток, остальные ждут на условии'''
+        deadline = time.monotonic() + timeout
+        self.stats['waits'] += 1
+        while True:
+            with self._cond:
+                while True:
+                    if self.latest_id > after_id:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        return False
+                    if not self._polling:
+                        self._polling = True
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self._poll(remaining)
+            finally:
+                with self._cond:
+                    self._polling = False
+                    self._cond.notify_all()
+
+event_listener = EventListener(EVENTS_CHANNEL)
+
+def fetch_events(req, position, post_id, limit: int) -> list:
+    '''События после позиции (tx, id) из транзакций, завершённых для всех: порядок выдачи совпадает с порядком коммитов'''
+    post_sql = "AND e.post_id = %s" if post_id else ""
+    req.cur.execute(f"""
+        SELECT e.tx, e.id, e.kind, e.post_id, e.data, e.created_at
+        FROM forum_events e
+        WHERE (e.tx, e.id) > (%s, %s) {post_sql}
+          AND e.tx < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY e.tx, e.id
+        LIMIT %s
+    """, [*position, *([post_id] if post_id else []), limit])
+    return req.cur.fetchall()
+
+def events_head(req) -> list:
+    req.cur.execute("""
+        SELECT e.tx, e.id FROM forum_events e
+        WHERE e.tx < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY e.tx DESC, e.id DESC
+        LIMIT 1
+    """)
+    row = req.cur.fetchone()
+    return [row['tx'], row['id']] if row else [0, 0]
+
+def events_response(sse: bool, events: list, cursor: str, reset: bool = False) -> dict:
+    if not sse:
+        payload = {'events': events, 'cursor': cursor}
+        if reset:
+            payload['reset'] = True
+        return json_response(payload)
+    # EventSource сам переподключается через retry и присылает последний id в Last-Event-ID
+    chunks = [f'retry: {EVENTS_RETRY_MS}\n']
+    if reset:
+        chunks.append(f'id: {cursor}\nevent: reset\ndata: {{}}\n\n')
+    for event in events:
+        event_cursor = encode_cursor(event['tx'], event['id'])
+        chunks.append(f"id: {event_cursor}\nevent: {event['kind']}\ndata: {dumps(event)}\n\n")
+    if not events and not reset:
+        chunks.append(f'id: {cursor}\n\n')
+    return {'statusCode': 200, 'headers': SSE_HEADERS, 'body': ''.join(chunks), 'isBase64Encoded': False}
+
+# Получить посты (keyset-пагинация по столбцу порядка и id: новые, обсуждаемые или «горячие»)
+@router.route('GET', 'posts', replica=True)
+def posts(req):
+    cache_key = ('posts', tuple(sorted(req.params.items())))
+    refresh_caches(req)
+    cached = response_cache.get('posts', cache_key)
+    if cached:
+        return cached_response(req, *cached)
+
+    category = req.params.get('category')
+    sort = req.params.get('sort') or 'new'
+    sort_column = POST_SORTS.get(sort)
+    if sort_column is None:
+        raise HTTPError(400, f"sort must be one of: {', '.join(POST_SORTS)}")
+    limit = page_limit(req.params, POSTS_PAGE_SIZE, POSTS_MAX_PAGE_SIZE)
+    excerpt = req.params.get('excerpt') in ('1', 'true')
+    cursor = decode_cursor(req.params.get('cursor'), 3)
+    if cursor:
+        if cursor[0] != sort:
+            raise HTTPError(400, 'Cursor belongs to another sort order')
+        cursor = cursor[1:]
+
+    if excerpt:
+        content_sql = "LEFT(p.content, %s) as excerpt, char_length(p.content) > %s as truncated"
+        query_params = [POST_EXCERPT_LENGTH, POST_EXCERPT_LENGTH]
+    else:
+        content_sql = "p.content"
+        query_params = []
+
+    conditions = []
+    if category:
+        conditions.append("p.category = %s")
+        query_params.append(category)
+    if cursor:
+        conditions.append(f"(p.{sort_column}, p.id) < (%s, %s)")
+        query_params.extend(cursor)
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query_params.append(limit + 1)
+
+    post_likes.fold_if_due(req.primary)
+    req.cur.execute(f"""
+        SELECT p.id, p.user_id, p.title, {content_sql}, p.category, p.likes, p.comment_count,
+               p.created_at, p.last_activity_at, p.hot_score,
+               u.username, u.avatar_url, u.admin_role
+        FROM forum_posts p
+        JOIN users u ON p.user_id = u.id
+        {where_sql}
+        ORDER BY p.{sort_column} DESC, p.id DESC
+        LIMIT %s
+    """, query_params)
+
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(sort, rows[limit - 1][sort_column], rows[limit - 1]['id']) if len(rows) > limit else None
+    return cacheable_json_response(req, 'posts', cache_key, {'posts': rows[:limit], 'nextCursor': next_cursor})
+
+def timeline_positions(cursor: str) -> list:
+    '''Позиции источников из курсора ленты: None — с начала, False — источник исчерпан, [created_at, id] — после строки'''
+    positions = decode_cursor(cursor, len(TIMELINE_SOURCES)) or [None] * len(TIMELINE_SOURCES)
+    for position in positions:
+        if position not in (None, False) and not (isinstance(position, list) and len(position) == 2):
+            raise HTTPError(400, 'Invalid cursor')
+    return positions
+
+# Лента активности: посты, комментарии и новости одной страницей. Каждый источник отдаёт не больше limit строк
+# после своей позиции, упорядоченные потоки сливаются, а курсор хранит позицию каждого источника
+@router.route('GET', 'timeline', replica=True)
+def timeline(req):
+    limit = page_limit(req.params, TIMELINE_PAGE_SIZE, TIMELINE_MAX_PAGE_SIZE)
+    positions = timeline_positions(req.params.get('cursor'))
+    user_id = req.params.get('userId')
+    query_params = {'excerpt': POST_EXCERPT_LENGTH, 'limit': limit}
+    if user_id:
+        try:
+            query_params['user_id'] = int(user_id)
+        except ValueError:
+            raise HTTPError(400, 'Invalid userId')
+
+    branches = []
+    for kind, position in zip(TIMELINE_SOURCES, positions):
+        if position is False:
+            continue
+        alias, author_column, select_sql = TIMELINE_SOURCES[kind]
+        conditions = [f"{alias}.created_at IS NOT NULL"]
+        if user_id:
+            conditions.append(f"{alias}.{author_column} = %(user_id)s")
+        if position:
+            conditions.append(f"({alias}.created_at, {alias}.id) < (%({kind}_at)s, %({kind}_id)s)")
+            query_params[f'{kind}_at'], query_params[f'{kind}_id'] = position
+        branches.append(f"""({select_sql}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {alias}.created_at DESC, {alias}.id DESC
+            LIMIT %(limit)s)""")
+
+    streams = {kind: [] for kind in TIMELINE_SOURCES}
+    if branches:
+        req.cur.execute(' UNION ALL '.join(branches), query_params)
+        for row in req.cur.fetchall():
+            streams[row['kind']].append(row)
+
+    order = {kind: rank for rank, kind in enumerate(TIMELINE_SOURCES)}
+    key = lambda row: (row['created_at'], -order[row['kind']], row['id'])
+    for rows in streams.values():
+        rows.sort(key=key, reverse=True)
+    items = list(islice(heapq.merge(*streams.values(), key=key, reverse=True), limit))
+
+    # Позиция источника сдвигается на последнюю выданную строку; источник исчерпан, если он вернул меньше
+    # limit строк и все они попали на страницу
+    consumed = {kind: [row for row in items if row['kind'] == kind] for kind in TIMELINE_SOURCES}
+    next_positions = []
+    for kind, position in zip(TIMELINE_SOURCES, positions):
+        taken = consumed[kind]
+        if position is False or (len(streams[kind]) < limit and len(taken) == len(streams[kind])):
+            next_positions.append(False)
+        else:
+            next_positions.append([taken[-1]['created_at'], taken[-1]['id']] if taken else position)
+    next_cursor = None if all(p is False for p in next_positions) else encode_cursor(*next_positions)
+    return json_response({'items': items, 'nextCursor': next_cursor})
+
+# Полнотекстовый поиск по постам и комментариям
+@router.route('GET', 'search', replica=True)
+def search(req):
+    query = (req.params.get('q') or '').strip()
+    if not query:
+        raise HTTPError(400, 'Search query required')
+    limit = page_limit(req.params, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+    rank, kind, item_id = decode_cursor(req.params.get('cursor'), 3) or (None, None, None)
+
+    # Ранжируются все совпадения из GIN-индекса; каждый источник отдаёт только лучшие limit + 1 после курсора,
+    # поэтому сортировка — top-N с постоянной памятью, а стоимость растёт лишь с числом совпадений
+    req.cur.execute("""
+        WITH q AS (
+            SELECT websearch_to_tsquery('russian', %(query)s) as query
+        ), post_hits AS (
+            SELECT 'post' as kind, p.id, p.id as post_id, p.user_id, p.created_at, ts_rank(p.search_vector, q.query)::float8 as rank
+            FROM forum_posts p, q
+            WHERE p.search_vector @@ q.query
+              AND (%(rank)s::float8 IS NULL OR (ts_rank(p.search_vector, q.query)::float8, 'post', p.id) < (%(rank)s, %(kind)s, %(id)s))
+            ORDER BY rank DESC, p.id DESC
+            LIMIT %(limit)s
+        ), comment_hits AS (
+            SELECT 'comment' as kind, c.id, c.post_id, c.user_id, c.created_at, ts_rank(c.search_vector, q.query)::float8 as rank
+            FROM forum_comments c, q
+            WHERE c.search_vector @@ q.query
+              AND (%(rank)s::float8 IS NULL OR (ts_rank(c.search_vector, q.query)::float8, 'comment', c.id) < (%(rank)s, %(kind)s, %(id)s))
+            ORDER BY rank DESC, c.id DESC
+            LIMIT %(limit)s
+        ), page AS (
+            SELECT * FROM post_hits
+            UNION ALL
+            SELECT * FROM comment_hits
+            ORDER BY rank DESC, kind DESC, id DESC
+            LIMIT %(limit)s
+        )
+        SELECT page.kind, page.id, page.post_id, page.user_id, page.created_at, page.rank,
+               pp.title, u.username,
+               ts_headline('russian', COALESCE(c.content, pp.content), q.query, %(headline)s) as snippet
+        FROM page
+        CROSS JOIN q
+        JOIN forum_posts pp ON pp.id = page.post_id
+        LEFT JOIN forum_comments c ON page.kind = 'comment' AND c.id = page.id
+        JOIN users u ON u.id = page.user_id
+        ORDER BY page.rank DESC, page.kind DESC, page.id DESC
+    """, {
+        'query': query, 'rank': rank, 'kind': kind, 'id': item_id,
+        'limit': limit + 1, 'headline': SEARCH_HEADLINE_OPTIONS
+    })
+
+    rows = req.cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last['rank'], last['kind'], last['id'])
+    return json_response({'results': rows[:limit], 'nextCursor': next_cursor})
+
+# Создать пост
+@router.route('POST', 'create-post')
+def create_post(req):
+    user_id = flood_guard.admit(req, 'create-post', FLOOD_LIMITS['create-post'], user_id=lambda: resolve_author_id(req), speaking=True)
+    title = req.body.get('title')
+    content = req.body.get('content')
+    category = req.body.get('category', 'общее')
+
+    req.cur.execute("""
+        WITH post AS (
+            INSERT INTO forum_posts (user_id, title, content, category) VALUES (%s, %s, %s, %s)
+            RETURNING id, user_id, title, content, category, likes, created_at
+        )
+        SELECT post.*, u.username, u.admin_role
+        FROM post LEFT JOIN users u ON u.id = post.user_id
+    """, (user_id, title, content, category))
+    post = req.cur.fetchone()
+    publish_response_change(req.cur, 'posts')
+    publish_forum_event(req.cur, 'post', post['id'], dict(post, content=(post['content'] or '')[:POST_EXCERPT_LENGTH]))
+    if post['user_id']:
+        experience_ledger.award(req.cur, post['user_id'], XP_AWARDS['post'], 'post')
+    req.conn.commit()
+
+    experience_ledger.fold_if_due(req.conn)
+    return json_response({'success': True, 'post': post})
+
+# Получить комментарии к посту
+@router.route('GET', 'comments', replica=True)
+def comments(req):
+    post_id = req.params.get('postId')
+    scope = f'comments:{post_id}'
+    refresh_caches(req)
+    cached = response_cache.get(scope, scope)
+    if cached:
+        return cached_response(req, *cached)
+
+    req.cur.execute("""
+        SELECT c.id, c.post_id, c.user_id, c.content,
+               u.username, u.avatar_url
+        FROM forum_comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.post_id = %s
+        ORDER BY c.created_at ASC
+    """, (post_id,))
+
+    return cacheable_json_response(req, scope, scope, {'comments': req.cur.fetchall()})
+
+# Добавить комментарий
+@router.route('POST', 'add-comment')
+def add_comment(req):
+    user_id = flood_guard.admit(req, 'add-comment', FLOOD_LIMITS['add-comment'], user_id=lambda: resolve_author_id(req), speaking=True)
+    post_id = req.body.get('postId')
+    content = req.body.get('content')
+
+    # Счётчик комментариев и время активности темы меняются в той же транзакции, что и вставка
+    req.cur.execute("""
+        WITH comment AS (
+            INSERT INTO forum_comments (post_id, user_id, content)
+            SELECT id, %s, %s FROM forum_posts WHERE id = %s
+            RETURNING id, post_id, user_id, content, created_at
+        ), post AS (
+            UPDATE forum_posts p
+            SET comment_count = p.comment_count + 1, last_activity_at = comment.created_at
+            FROM comment
+            WHERE p.id = comment.post_id
+            RETURNING p.comment_count
+        )
+        SELECT comment.*, post.comment_count, u.username, u.avatar_url
+        FROM comment CROSS JOIN post LEFT JOIN users u ON u.id = comment.user_id
+    """, (user_id, content, post_id))
+    comment = req.cur.fetchone()
+    if not comment:
+        raise HTTPError(404, 'Post not found')
+    publish_response_change(req.cur, f'comments:{post_id}')
+    publish_response_change(req.cur, 'posts')
+    publish_forum_event(req.cur, 'comment', comment['post_id'], comment)
+    if comment['user_id']:
+        experience_ledger.award(req.cur, comment['user_id'], XP_AWARDS['comment'], 'comment')
+    req.conn.commit()
+
+    experience_ledger.fold_if_due(req.conn)
+    return json_response({'success': True, 'comment': comment})
+
+# Лайк поста
+@router.route('POST', 'like-post')
+def like_post(req):
+    post_id = req.body.get('postId')
+    likes = post_likes.increment(req.cur, post_id)
+    if likes is None:
+        raise HTTPError(404, 'Post not found')
+    publish_forum_event(req.cur, 'like', post_id, {'post_id': int(post_id), 'likes': likes})
+    req.conn.commit()
+
+    post_likes.fold_if_due(req.conn)
+    return json_response({'success': True, 'likes': likes})
+
+# Изменения форума после курсора: long-poll JSON или пачка Server-Sent Events для EventSource
+@router.route('GET', 'events', batchable=False)
+def events(req):
+    sse = 'text/event-stream' in (req.header('Accept') or '')
+    position = decode_cursor(req.params.get('cursor') or req.header('Last-Event-ID'), 2)
+    post_id = int(req.params['postId']) if req.params.get('postId') else None
+    limit = page_limit(req.params, EVENTS_PAGE_SIZE, EVENTS_PAGE_SIZE)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        body = json.loads(event.get('body', '{}')) if event.get('body') else {}
-        path = event.get('queryStringParameters', {}).get('action', '')
-        
-        # Получить все посты
-        if path == 'posts' and method == 'GET':
-            category = event.get('queryStringParameters', {}).get('category')
-            
-            if category:
-                cur.execute("""
-                    SELECT p.id, p.user_id, p.title, p.content, p.category, p.likes,
-                           u.username, u.avatar_url, u.admin_role
-                    FROM forum_posts p
-                    JOIN users u ON p.user_id = u.id
-                    WHERE p.category = %s
-                    ORDER BY p.created_at DESC
-                """, (category,))
-            else:
-                cur.execute("""
-                    SELECT p.id, p.user_id, p.title, p.content, p.category, p.likes,
-                           u.username, u.avatar_url, u.admin_role
-                    FROM forum_posts p
-                    JOIN users u ON p.user_id = u.id
-                    ORDER BY p.created_at DESC
-                """)
-            
-            posts = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'posts': [dict(p) for p in posts]}),
-                'isBase64Encoded': False
-            }
-        
-        # Создать пост
-        elif path == 'create-post' and method == 'POST':
-            user_id = body.get('userId')
-            title = body.get('title')
-            content = body.get('content')
-            category = body.get('category', 'общее')
-            
-            cur.execute(
-                "INSERT INTO forum_posts (user_id, title, content, category) VALUES (%s, %s, %s, %s) RETURNING id, user_id, title, content, category, likes",
-                (user_id, title, content, category)
-            )
-            post = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'post': dict(post)}),
-                'isBase64Encoded': False
-            }
-        
-        # Получить комментарии к посту
-        elif path == 'comments' and method == 'GET':
-            post_id = event.get('queryStringParameters', {}).get('postId')
-            
-            cur.execute("""
-                SELECT c.id, c.post_id, c.user_id, c.content,
-                       u.username, u.avatar_url
-                FROM forum_comments c
-                JOIN users u ON c.user_id = u.id
-                WHERE c.post_id = %s
-                ORDER BY c.created_at ASC
-            """, (post_id,))
-            
-            comments = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'comments': [dict(c) for c in comments]}),
-                'isBase64Encoded': False
-            }
-        
-        # Добавить комментарий
-        elif path == 'add-comment' and method == 'POST':
-            user_id = body.get('userId')
-            post_id = body.get('postId')
-            content = body.get('content')
-            
-            cur.execute(
-                "INSERT INTO forum_comments (post_id, user_id, content) VALUES (%s, %s, %s) RETURNING id, post_id, user_id, content",
-                (post_id, user_id, content)
-            )
-            comment = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'comment': dict(comment)}),
-                'isBase64Encoded': False
-            }
-        
-        # Лайк поста
-        elif path == 'like-post' and method == 'POST':
-            post_id = body.get('postId')
-            
-            cur.execute("UPDATE forum_posts SET likes = likes + 1 WHERE id = %s RETURNING likes", (post_id,))
-            result = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'likes': result['likes']}),
-                'isBase64Encoded': False
-            }
-        
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Endpoint not found'}),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        wait = min(max(float(req.params.get('wait', EVENTS_MAX_WAIT)), 0.0), EVENTS_MAX_WAIT)
+    except ValueError:
+        raise HTTPError(400, 'Invalid wait')
+
+    # Без курсора клиент только что загрузил ленту: отдаём текущую позицию журнала
+    if position is None:
+        return events_response(sse, [], encode_cursor(*events_head(req)))
+
+    # Курсор старше самого раннего сохранённого события: часть изменений уже удалена из журнала
+    req.cur.execute("SELECT tx, id FROM forum_events ORDER BY tx, id LIMIT 1")
+    oldest = req.cur.fetchone()
+    if oldest and position != [0, 0] and position < [oldest['tx'], oldest['id']]:
+        return events_response(sse, [], encode_cursor(*events_head(req)), reset=True)
+
+    deadline = time.monotonic() + wait
+    seen = event_listener.latest_id
+    settle = 0
+    while True:
+        rows = fetch_events(req, position, post_id, limit)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            break
+        # Ожидание не держит соединение пула: его заберёт следующий запрос контейнера
+        req.close()
+        if settle:
+            settle -= 1
+            time.sleep(min(EVENTS_SETTLE_DELAY, remaining))
+        elif event_listener.wait_for(seen, remaining):
+            seen = event_listener.latest_id
+            settle = EVENTS_SETTLE_CHECKS
+
+    cursor = encode_cursor(rows[-1]['tx'], rows[-1]['id']) if rows else encode_cursor(*position)
+    return events_response(sse, rows, cursor)
+
+# Статистика слушателя уведомлений
+@router.route('GET', 'events-stats')
+def events_stats(req):
+    return json_response({'listener': event_listener.stats, 'latestId': event_listener.latest_id})
+
+def handler(event: dict, context) -> dict:
+    return router.dispatch(event)
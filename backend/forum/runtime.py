@@ -0,0 +1,1122 @@
+'''Общий рантайм облачных функций Russian Town: пул соединений, кэши, маршрутизация и ответы.
+Функции деплоятся независимо, поэтому одинаковая копия модуля лежит в каталоге каждой функции.'''
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', '5'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+INVALIDATION_POLL_INTERVAL = float(os.environ.get('INVALIDATION_POLL_INTERVAL', '2'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '300'))
+SESSION_TTL = timedelta(days=int(os.environ.get('SESSION_TTL_DAYS', '30')))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '5000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+LIKE_SHARDS = int(os.environ.get('LIKE_SHARDS', '16'))
+LIKE_FOLD_INTERVAL = float(os.environ.get('LIKE_FOLD_INTERVAL', '5'))
+LIKE_TARGETS = {'post': 'forum_posts', 'gallery': 'gallery'}
+XP_FOLD_INTERVAL = float(os.environ.get('XP_FOLD_INTERVAL', '5'))
+XP_FOLD_LOCK = 7021
+# faction_id общей таблицы лидеров и ширина корзины счётчиков (см. V0015)
+LEADERBOARD_GLOBAL = 0
+LEADERBOARD_BUCKET = 100
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') == '1'
+DATABASE_REPLICA_URLS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', '5'))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', '5'))
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', '10'))
+# Время последней записи клиента: сервер отдаёт его в ответе на запись, клиент возвращает в следующих запросах
+LAST_WRITE_HEADER = 'X-Last-Write'
+BATCH_MAX_ACTIONS = int(os.environ.get('BATCH_MAX_ACTIONS', '20'))
+BATCH_RETRIES = 3
+BATCH_RETRY_DELAY = 0.01
+FLOOD_CONTROL = os.environ.get('FLOOD_CONTROL', '1') == '1'
+FLOOD_SHARED = os.environ.get('FLOOD_SHARED', '1') == '1'
+FLOOD_LOCAL_KEYS = int(os.environ.get('FLOOD_LOCAL_KEYS', '20000'))
+FLOOD_STANDING_CACHE_SIZE = int(os.environ.get('FLOOD_STANDING_CACHE_SIZE', '5000'))
+FLOOD_PRUNE_INTERVAL = 60
+
+IMPORTED_AT = time.perf_counter()
+cold_start = {'first_response_ms': None}
+
+_psycopg2 = None
+
+def psycopg():
+    '''Ленивый импорт psycopg2: OPTIONS и ответы из кэша обходятся без загрузки драйвера'''
+    global _psycopg2
+    if _psycopg2 is None:
+        import psycopg2
+        import psycopg2.extensions
+        import psycopg2.extras
+        import psycopg2.pool
+        _psycopg2 = psycopg2
+    return _psycopg2
+
+class RequestTimings:
+    '''Замеры одного вызова: получение соединения, выполнение запросов, выборка строк и сериализация ответа'''
+    __slots__ = ('started', 'connect', 'execute', 'fetch', 'serialize', 'queries', 'slow_queries')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect = self.execute = self.fetch = self.serialize = 0.0
+        self.queries = 0
+        self.slow_queries = []
+
+    def as_dict(self) -> dict:
+        return {
+            'totalMs': round((time.perf_counter() - self.started) * 1000, 3),
+            'connectMs': round(self.connect * 1000, 3),
+            'executeMs': round(self.execute * 1000, 3),
+            'fetchMs': round(self.fetch * 1000, 3),
+            'serializeMs': round(self.serialize * 1000, 3),
+            'queries': self.queries
+        }
+
+    def server_timing(self) -> str:
+        return (
+            f'conn;dur={self.connect * 1000:.2f}, '
+            f'db;dur={self.execute * 1000:.2f};desc="{self.queries} queries", '
+            f'fetch;dur={self.fetch * 1000:.2f}, '
+            f'ser;dur={self.serialize * 1000:.2f}, '
+            f'total;dur={(time.perf_counter() - self.started) * 1000:.2f}'
+        )
+
+current_timings = ContextVar('current_timings', default=None)
+
+def explain(cur, query: str, vars) -> list:
+    '''План медленного запроса; EXPLAIN без ANALYZE, под точкой сохранения, чтобы не сломать транзакцию вызова'''
+    pg = psycopg()
+    with cur.connection.cursor(cursor_factory=pg.extensions.cursor) as plain:
+        try:
+            plain.execute('SAVEPOINT explain_slow_query')
+            plain.execute(b'EXPLAIN ' + cur.mogrify(query, vars))
+            plan = [row[0] for row in plain.fetchall()]
+            plain.execute('RELEASE SAVEPOINT explain_slow_query')
+            return plan
+        except pg.Error as e:
+            plain.execute('ROLLBACK TO SAVEPOINT explain_slow_query')
+            return [f'EXPLAIN failed: {e}']
+
+_cursor_class = None
+
+def cursor_class():
+    '''RealDictCursor, который записывает время выполнения и выборки в замеры текущего вызова'''
+    global _cursor_class
+    if _cursor_class is not None:
+        return _cursor_class
+
+    class InstrumentedCursor(psycopg().extras.RealDictCursor):
+        def execute(self, query, vars=None):
+            timings = current_timings.get()
+            started = time.perf_counter()
+            result = super().execute(query, vars)
+            elapsed = time.perf_counter() - started
+            if timings is not None:
+                timings.execute += elapsed
+                timings.queries += 1
+                if elapsed * 1000 >= SLOW_QUERY_MS and self.name is None:
+                    timings.slow_queries.append({
+                        'ms': round(elapsed * 1000, 3),
+                        'query': ' '.join(query.split())[:1000],
+                        'plan': explain(self, query, vars)
+                    })
+            return result
+
+        def _timed_fetch(self, fetch, *args):
+            timings = current_timings.get()
+            started = time.perf_counter()
+            rows = fetch(*args)
+            if timings is not None:
+                timings.fetch += time.perf_counter() - started
+            return rows
+
+        def fetchone(self):
+            return self._timed_fetch(super().fetchone)
+
+        def fetchmany(self, size=None):
+            return self._timed_fetch(super().fetchmany, size)
+
+        def fetchall(self):
+            return self._timed_fetch(super().fetchall)
+
+    _cursor_class = InstrumentedCursor
+    return _cursor_class
+
+class HTTPError(Exception):
+    '''Ошибка, которая превращается в JSON-ответ с заданным статусом (и, если нужно, заголовками)'''
+
+    def __init__(self, status: int, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+class ConnectionPool:
+    '''Пул соединений, живущий всё время жизни тёплого контейнера'''
+
+    def __init__(self, dsn: str, max_size: int, wait_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.healthcheck_after = healthcheck_after
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'discarded': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def getconn(self):
+        while True:
+            with self._cond:
+                idle = self._idle.pop() if self._idle else None
+                if idle is None:
+                    if self._size >= self.max_size:
+                        self.stats['waits'] += 1
+                        if not self._cond.wait_for(lambda: self._idle or self._size < self.max_size, self.wait_timeout):
+                            raise psycopg().pool.PoolError('Connection pool exhausted')
+                        continue
+                    self._size += 1
+            if idle is None:
+                return self._connect()
+            conn, released_at = idle
+            if self._is_healthy(conn, released_at):
+                self.stats['hits'] += 1
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        pg = psycopg()
+        if not conn.closed and conn.get_transaction_status() != pg.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except pg.Error:
+                pass
+        if conn.closed or conn.get_transaction_status() != pg.extensions.TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _connect(self):
+        pg = psycopg()
+        try:
+            conn = pg.connect(self.dsn, cursor_factory=cursor_class())
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self.stats['misses'] += 1
+        return conn
+
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg().Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg().Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._cond.notify()
+
+_db_pool = None
+
+def get_db_pool() -> ConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ConnectionPool(os.environ['DATABASE_URL'], DB_POOL_MAX_SIZE, DB_POOL_WAIT_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER)
+    return _db_pool
+
+def get_db_connection():
+    return get_db_pool().getconn()
+
+def release_db_connection(conn):
+    if conn is not None:
+        get_db_pool().putconn(conn)
+
+class TTLCache:
+    '''LRU-кэш в памяти контейнера с ограниченным временем жизни записей'''
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.stats['misses'] += 1
+            return None
+        self._data.move_to_end(key)
+        self.stats['hits'] += 1
+        return item[0]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        for key in [k for k, (v, _) in self._data.items() if predicate(k, v)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+class InvalidationFeed:
+    '''Читает журнал cache_invalidations, чтобы изменения из других функций доходили до тёплых контейнеров.
+    Позиция — (tx, id): читаются только транзакции, завершённые для всех, поэтому поздний коммит не пропускается'''
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.subscribers = {}
+        self.changed_at = float('-inf')
+        self._position = None
+        self._polled_at = 0.0
+
+    def subscribe(self, scope: str, callback):
+        self.subscribers.setdefault(scope, []).append(callback)
+
+    def is_due(self) -> bool:
+        return time.monotonic() - self._polled_at >= self.poll_interval
+
+    def poll(self, cur):
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval:
+            return
+        self._polled_at = now
+        if self._position is None:
+            # Всё из транзакций младше xmin уже было в базе до старта контейнера; остальное дочитается
+            cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) as xmin")
+            self._position = (cur.fetchone()['xmin'], 0)
+            return
+        cur.execute("""
+            SELECT tx, id, scope, key FROM cache_invalidations
+            WHERE (tx, id) > (%s, %s) AND tx < txid_snapshot_xmin(txid_current_snapshot())
+            ORDER BY tx, id
+        """, self._position)
+        for row in cur.fetchall():
+            self._position = (row['tx'], row['id'])
+            self.changed_at = time.monotonic()
+            for callback in self.subscribers.get(row['scope'], []):
+                callback(row['key'])
+
+invalidation_feed = InvalidationFeed(INVALIDATION_POLL_INTERVAL)
+
+def publish_invalidation(cur, scope: str, keys):
+    cur.execute("""
+        WITH pruned AS (
+            DELETE FROM cache_invalidations WHERE created_at < CURRENT_TIMESTAMP - INTERVAL '1 day'
+        )
+        INSERT INTO cache_invalidations (scope, key)
+        SELECT %s, unnest(%s::text[])
+    """, (scope, [str(k) for k in keys]))
+    invalidation_feed.changed_at = time.monotonic()
+
+def refresh_caches(req):
+    '''Дочитывает журнал инвалидаций, если подошёл срок; соединение берётся только в этом случае'''
+    if invalidation_feed.is_due():
+        invalidation_feed.poll(req.cur)
+
+class ReplicaSet:
+    '''Пулы реплик для чтения. Реплика, отставшая больше REPLICA_MAX_LAG или недоступная, пропускается до следующей
+    проверки; клиент, только что писавший в базу, READ_YOUR_WRITES_WINDOW секунд читает с основной. Время записи
+    приходит от клиента в LAST_WRITE_HEADER, поэтому правило работает в любом контейнере'''
+
+    def __init__(self, dsns: list, max_lag: float, check_interval: float, sticky_window: float):
+        self.dsns = dsns
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lags = [None] * len(dsns)
+        self.stats = {'replica': 0, 'primary': 0, 'sticky': 0, 'lagging': 0, 'unavailable': 0}
+        self.sticky_window = sticky_window
+        self._pools = [None] * len(dsns)
+        self._checked_at = [float('-inf')] * len(dsns)
+        self._healthy = [True] * len(dsns)
+        self._next = 0
+
+    def getconn(self, last_write: float = None):
+        '''Возвращает (индекс, пул, соединение) реплики или None, если читать нужно с основной'''
+        if not self.dsns:
+            return None
+        if last_write is not None and abs(time.time() - last_write) < self.sticky_window:
+            self.stats['sticky'] += 1
+            return None
+        start = self._next
+        self._next = (self._next + 1) % len(self.dsns)
+        for offset in range(len(self.dsns)):
+            index = (start + offset) % len(self.dsns)
+            due = time.monotonic() - self._checked_at[index] >= self.check_interval
+            if not due and not self._healthy[index]:
+                continue
+            pool = self._pool(index)
+            try:
+                conn = pool.getconn()
+            except psycopg().Error:
+                self._mark(index, None)
+                self.stats['unavailable'] += 1
+                continue
+            if due and not self._mark(index, self._measure_lag(conn)):
+                pool.putconn(conn)
+                continue
+            self.stats['replica'] += 1
+            return index, pool, conn
+        self.stats['primary'] += 1
+        return None
+
+    def _pool(self, index: int) -> ConnectionPool:
+        if self._pools[index] is None:
+            self._pools[index] = ConnectionPool(self.dsns[index], DB_POOL_MAX_SIZE, DB_POOL_WAIT_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER)
+        return self._pools[index]
+
+    def _measure_lag(self, conn):
+        '''Отставание воспроизведения в секундах; если всё полученное уже применено, реплика не отстаёт,
+        даже когда основная давно ничего не писала'''
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                    END::float8 as lag
+                """)
+                lag = cur.fetchone()['lag']
+            conn.rollback()
+            return lag
+        except psycopg().Error:
+            return None
+
+    def _mark(self, index: int, lag) -> bool:
+        self._checked_at[index] = time.monotonic()
+        self.lags[index] = lag
+        self._healthy[index] = lag is not None and lag <= self.max_lag
+        if lag is not None and not self._healthy[index]:
+            self.stats['lagging'] += 1
+        return self._healthy[index]
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS, REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL, READ_YOUR_WRITES_WINDOW)
+
+def make_etag(body: str) -> str:
+    return '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+
+class ResponseCache:
+    '''Сериализованные ответы с ETag; запись устаревает, когда версия её области меняется.
+    Область вида 'comments:5' устаревает и вместе с общей 'comments' — так сбрасываются все её подобласти сразу'''
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.versions = {}
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def bump(self, scope: str):
+        self.versions[scope] = self.versions.get(scope, 0) + 1
+
+    def version(self, scope: str):
+        family = scope.split(':', 1)[0]
+        return self.versions.get(scope, 0), self.versions.get(family, 0) if family != scope else 0
+
+    def get(self, scope: str, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != self.version(scope) or entry[3] <= time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[1], entry[2]
+
+    def set(self, scope: str, key, body: str) -> str:
+        etag = make_etag(body)
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (self.version(scope), etag, body, time.monotonic() + self.ttl)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+        return etag
+
+    def _drop(self, key):
+        self._bytes -= len(self._entries.pop(key)[2])
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+invalidation_feed.subscribe('response', response_cache.bump)
+
+def publish_response_change(cur, scope: str):
+    publish_invalidation(cur, 'response', [scope])
+    response_cache.bump(scope)
+
+class LikeCounter:
+    '''Шардированный счётчик лайков: всплеск пишется в шарды, а не в строку цели, и сворачивается в likes раз в LIKE_FOLD_INTERVAL.
+    on_fold(cur, totals) получает свёрнутые приращения {target_id: delta} в той же транзакции'''
+
+    def __init__(self, target_type: str, response_scope: str = None, on_fold=None):
+        self.target_type = target_type
+        self.table = LIKE_TARGETS[target_type]
+        self.response_scope = response_scope
+        self.on_fold = on_fold
+        self._folded_at = 0.0
+
+    def increment(self, cur, target_id: int):
+        cur.execute(f"""
+            WITH target AS (
+                SELECT id, COALESCE(likes, 0) as likes FROM {self.table} WHERE id = %(id)s
+            ), bump AS (
+                INSERT INTO like_counter_shards (target_type, target_id, shard, delta)
+                SELECT %(type)s, id, %(shard)s, 1 FROM target
+                ON CONFLICT (target_type, target_id, shard)
+                DO UPDATE SET delta = like_counter_shards.delta + 1
+            )
+            SELECT t.likes + 1 + COALESCE((
+                SELECT SUM(s.delta) FROM like_counter_shards s
+                WHERE s.target_type = %(type)s AND s.target_id = t.id
+            ), 0) as likes
+            FROM target t
+        """, {'id': target_id, 'type': self.target_type, 'shard': random.randrange(LIKE_SHARDS)})
+        row = cur.fetchone()
+        return row['likes'] if row else None
+
+    def fold_if_due(self, conn):
+        now = time.monotonic()
+        if now - self._folded_at < LIKE_FOLD_INTERVAL:
+            return
+        self._folded_at = now
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                WITH drained AS (
+                    DELETE FROM like_counter_shards WHERE target_type = %s
+                    RETURNING target_id, delta
+                ), totals AS (
+                    SELECT target_id, SUM(delta) as delta FROM drained GROUP BY target_id
+                )
+                UPDATE {self.table} t SET likes = COALESCE(t.likes, 0) + totals.delta
+                FROM totals WHERE t.id = totals.target_id
+                RETURNING t.id, totals.delta
+            """, (self.target_type,))
+            totals = {r['id']: r['delta'] for r in cur.fetchall()}
+            if totals and self.on_fold:
+                self.on_fold(cur, totals)
+            if totals and self.response_scope:
+                publish_response_change(cur, self.response_scope)
+        conn.commit()
+
+# Изменение счётчиков таблицы лидеров по CTE moves(faction_id, experience, delta): один игрок с опытом experience
+# приходит (+1) в область faction_id или уходит из неё (-1); опыт 0 не учитывается
+LEADERBOARD_COUNTS_UPSERT = f"""
+    INSERT INTO leaderboard_counts (faction_id, width, value, users)
+    SELECT m.faction_id, w.width, m.experience / w.width, SUM(m.delta)
+    FROM moves m
+    CROSS JOIN (VALUES (1), ({LEADERBOARD_BUCKET})) w(width)
+    WHERE m.experience > 0 AND m.faction_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    HAVING SUM(m.delta) <> 0
+    ON CONFLICT (faction_id, width, value) DO UPDATE SET users = leaderboard_counts.users + EXCLUDED.users
+"""
+
+FACTION_COUNTS_UPDATE = """
+    UPDATE factions f
+    SET member_count = f.member_count + d.members,
+        admin_count = f.admin_count + d.admins,
+        banned_count = f.banned_count + d.banned
+    FROM (
+        SELECT faction_id, SUM(members) as members, SUM(admins) as admins, SUM(banned) as banned
+        FROM member_moves
+        WHERE faction_id IS NOT NULL
+        GROUP BY faction_id
+    ) d
+    WHERE f.id = d.faction_id
+    RETURNING f.id
+"""
+
+class ExperienceLedger:
+    '''Начисления опыта пишутся в буфер experience_awards и раз в XP_FOLD_INTERVAL сворачиваются одним запросом:
+    experience, rank_level по порогам rank_levels и счётчики таблицы лидеров. Свёртки сериализованы advisory-блокировкой,
+    поэтому прежний опыт, прочитанный в начале запроса, совпадает с тем, что обновляется'''
+
+    def __init__(self, fold_interval: float):
+        self.fold_interval = fold_interval
+        self.stats = {'folds': 0, 'skipped': 0, 'users': 0}
+        self._folded_at = 0.0
+
+    def award(self, cur, user_id: int, amount: int, reason: str):
+        cur.execute(
+            "INSERT INTO experience_awards (user_id, amount, reason) VALUES (%s, %s, %s)",
+            (user_id, amount, reason)
+        )
+
+    def fold_if_due(self, conn):
+        now = time.monotonic()
+        if now - self._folded_at < self.fold_interval:
+            return
+        self._folded_at = now
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) as locked", (XP_FOLD_LOCK,))
+            if not cur.fetchone()['locked']:
+                # Транзакцию не откатываем: внутри пакета это транзакция всего пакета
+                self.stats['skipped'] += 1
+                return
+            cur.execute(f"""
+                WITH drained AS (
+                    DELETE FROM experience_awards RETURNING user_id, amount
+                ), totals AS (
+                    SELECT d.user_id, SUM(d.amount)::int as delta, u.experience as old_experience
+                    FROM drained d
+                    JOIN users u ON u.id = d.user_id
+                    GROUP BY d.user_id, u.experience
+                ), updated AS (
+                    UPDATE users u
+                    SET experience = GREATEST(t.old_experience + t.delta, 0),
+                        rank_level = (
+                            SELECT MAX(r.level) FROM rank_levels r
+                            WHERE r.min_experience <= GREATEST(t.old_experience + t.delta, 0)
+                        )
+                    FROM totals t
+                    WHERE u.id = t.user_id
+                    RETURNING u.id, u.faction_id, t.old_experience, u.experience
+                ), moves AS (
+                    SELECT s.faction_id, x.experience, x.delta
+                    FROM updated up
+                    CROSS JOIN LATERAL (VALUES (up.old_experience, -1), (up.experience, 1)) x(experience, delta)
+                    CROSS JOIN LATERAL (VALUES ({LEADERBOARD_GLOBAL}), (up.faction_id)) s(faction_id)
+                ), counted AS (
+                    {LEADERBOARD_COUNTS_UPSERT}
+                )
+                SELECT id FROM updated
+            """)
+            user_ids = [r['id'] for r in cur.fetchall()]
+            self.stats['folds'] += 1
+            self.stats['users'] += len(user_ids)
+            if user_ids:
+                publish_invalidation(cur, 'profile', user_ids)
+                publish_response_change(cur, 'leaderboard')
+        conn.commit()
+
+experience_ledger = ExperienceLedger(XP_FOLD_INTERVAL)
+
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+invalidation_feed.subscribe('session', session_cache.invalidate)
+invalidation_feed.subscribe('session-user', lambda key: session_cache.invalidate_where(lambda _, user: user['id'] == int(key)))
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def resolve_session(req, token: str) -> dict:
+    '''Возвращает пользователя по токену сессии; проверенные токены кэшируются, при промахе срок сессии продлевается.
+    Продление — запись, поэтому идёт через основную базу, даже если маршрут читает с реплики'''
+    if not token:
+        return None
+    token_hash = hash_token(token)
+    user = session_cache.get(token_hash)
+    if user is not None:
+        return user
+
+    conn = req.primary
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE sessions s
+            SET last_seen_at = CURRENT_TIMESTAMP, expires_at = CURRENT_TIMESTAMP + %s
+            FROM users u
+            WHERE s.token_hash = %s AND s.user_id = u.id
+              AND s.revoked_at IS NULL AND s.expires_at > CURRENT_TIMESTAMP
+              AND NOT COALESCE(u.is_banned, FALSE)
+            RETURNING u.id, u.username, u.admin_role, COALESCE(u.is_muted, FALSE) as is_muted
+        """, (SESSION_TTL, token_hash))
+        row = cur.fetchone()
+    conn.commit()
+    if not row:
+        return None
+    user = dict(row)
+    session_cache.set(token_hash, user)
+    return user
+
+class FloodGuard:
+    '''Ограничение частоты записей токен-бакетами по ключам (пользователь, адрес, логин).
+    Сначала — локальный бакет адреса, до любой работы с базой; затем сессия, кэшированная проверка бана и мута
+    и локальные бакеты остальных ключей. Прошедший их запрос последним шагом списывает токены из общих бакетов
+    rate_limit_buckets одним запросом, чтобы лимит соблюдался суммарно по всем контейнерам'''
+
+    def __init__(self, enabled: bool, shared: bool, max_keys: int):
+        self.enabled = enabled
+        self.shared = shared
+        self.max_keys = max_keys
+        self.standing = TTLCache(FLOOD_STANDING_CACHE_SIZE, SESSION_CACHE_TTL)
+        self.stats = {'allowed': 0, 'rejected_local': 0, 'rejected_shared': 0, 'banned': 0, 'muted': 0, 'rejected_by_action': {}}
+        self._buckets = OrderedDict()
+        self._pruned_at = 0.0
+
+    def user_standing(self, req, user_id: int) -> dict:
+        '''Бан и мут пользователя; сбрасывается по событию session-user, которое публикуют ban и mute'''
+        refresh_caches(req)
+        standing = self.standing.get(user_id)
+        if standing is None:
+            req.cur.execute("SELECT COALESCE(is_banned, FALSE) as is_banned, COALESCE(is_muted, FALSE) as is_muted FROM users WHERE id = %s", (user_id,))
+            row = req.cur.fetchone()
+            standing = dict(row) if row else {'is_banned': False, 'is_muted': False}
+            self.standing.set(user_id, standing)
+        return standing
+
+    def admit(self, req, action: str, limit: tuple, user_id=None, keys=(), speaking: bool = False):
+        '''Пропускает запрос или бросает 401/403 (бан, мут при speaking) или 429; limit — (запросов, за секунд).
+        user_id — id или функция, которая его находит (например, по токену сессии): она вызывается только после
+        локального бакета адреса, поэтому поток с неверными токенами отсекается до базы. Возвращает id пользователя.
+        Бан и мут проверяются всегда, FLOOD_CONTROL=0 выключает только ограничение частоты'''
+        burst, period = limit
+        rate = burst / period
+        ip = req.source_ip()
+        ip_keys = [f'{action}:ip:{ip}'] if ip and self.enabled else []
+        self._take_local(action, ip_keys, burst, rate)
+
+        if callable(user_id):
+            user_id = user_id()
+        if user_id is not None:
+            standing = self.user_standing(req, int(user_id))
+            if standing['is_banned']:
+                self.stats['banned'] += 1
+                raise HTTPError(403, 'Account is banned')
+            if speaking and standing['is_muted']:
+                self.stats['muted'] += 1
+                raise HTTPError(403, 'User is muted')
+        if not self.enabled:
+            return user_id
+
+        keys = list(keys)
+        if user_id is not None:
+            keys.append(f'user:{user_id}')
+        keys = [f'{action}:{key}' for key in keys]
+        self._take_local(action, keys, burst, rate)
+        if self.shared and keys + ip_keys:
+            self._take_shared(req, action, keys + ip_keys, burst, rate)
+        self.stats['allowed'] += 1
+        return user_id
+
+    def _take_local(self, action: str, keys: list, burst: int, rate: float):
+        now = time.monotonic()
+        levels = []
+        for key in keys:
+            tokens, stamp = self._buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens < 1:
+                self._reject('rejected_local', action, (1 - tokens) / rate)
+            levels.append(tokens)
+        for key, tokens in zip(keys, levels):
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def _take_shared(self, req, action: str, keys: list, burst: int, rate: float):
+        # Пополнение и списание атомарны: конкурирующие запросы с тем же ключом ждут блокировку строки бакета
+        req.cur.execute("SAVEPOINT flood_take")
+        req.cur.execute("""
+            INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+            SELECT key, %(burst)s - 1, clock_timestamp() FROM unnest(%(keys)s::text[]) key
+            ON CONFLICT (key) DO UPDATE
+            SET tokens = LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) - 1,
+                updated_at = clock_timestamp()
+            WHERE LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) >= 1
+            RETURNING key
+        """, {'keys': keys, 'burst': burst, 'rate': rate})
+        if len(req.cur.fetchall()) < len(keys):
+            # Токены, списанные с остальных ключей, возвращаются откатом до точки сохранения
+            req.cur.execute("ROLLBACK TO SAVEPOINT flood_take")
+            self._reject('rejected_shared', action, 1 / rate)
+        req.cur.execute("RELEASE SAVEPOINT flood_take")
+        if time.monotonic() - self._pruned_at > FLOOD_PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            req.cur.execute("DELETE FROM rate_limit_buckets WHERE updated_at < clock_timestamp() - INTERVAL '1 day'")
+        # Списание фиксируется сразу: неудачный вход тоже тратит токен, а блокировка бакета не держится весь запрос
+        req.conn.commit()
+
+    def _reject(self, reason: str, action: str, retry_after: float):
+        self.stats[reason] += 1
+        self.stats['rejected_by_action'][action] = self.stats['rejected_by_action'].get(action, 0) + 1
+        raise HTTPError(429, 'Too many requests, slow down', {'Retry-After': str(max(math.ceil(retry_after), 1))})
+
+flood_guard = FloodGuard(FLOOD_CONTROL, FLOOD_SHARED, FLOOD_LOCAL_KEYS)
+invalidation_feed.subscribe('session-user', lambda key: flood_guard.standing.invalidate(int(key)))
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+if orjson is not None:
+    def dumps(payload) -> str:
+        return orjson.dumps(payload, default=json_default).decode()
+else:
+    def dumps(payload) -> str:
+        return json.dumps(payload, default=json_default, ensure_ascii=False, separators=(',', ':'))
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, size: int):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPError(400, 'Invalid cursor')
+    return values
+
+def page_limit(params: dict, default: int, maximum: int) -> int:
+    try:
+        return min(max(int(params.get('limit') or default), 1), maximum)
+    except ValueError:
+        raise HTTPError(400, 'Invalid limit')
+
+class FrozenHeaders(dict):
+    '''Неизменяемый набор заголовков, собранный один раз при импорте'''
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Headers are immutable')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+JSON_HEADERS = FrozenHeaders({'Content-Type': 'application/json; charset=utf-8', 'Access-Control-Allow-Origin': '*'})
+CACHED_JSON_HEADERS = {
+    'Content-Type': 'application/json; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Expose-Headers': 'ETag'
+}
+NOT_MODIFIED_HEADERS = {k: v for k, v in CACHED_JSON_HEADERS.items() if k != 'Content-Type'}
+NOT_FOUND_BODY = dumps({'error': 'Endpoint not found'})
+
+def serialize(payload) -> str:
+    timings = current_timings.get()
+    started = time.perf_counter()
+    body = dumps(payload)
+    if timings is not None:
+        timings.serialize += time.perf_counter() - started
+    return body
+
+def json_response(payload, status: int = 200, headers: dict = JSON_HEADERS) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': serialize(payload), 'isBase64Encoded': False}
+
+def error_response(status: int, message: str, headers: dict = None) -> dict:
+    return json_response({'error': message}, status, FrozenHeaders(JSON_HEADERS, **headers) if headers else JSON_HEADERS)
+
+def cached_response(req, etag: str, body: str) -> dict:
+    if_none_match = req.header('If-None-Match') or ''
+    if etag in (t.strip().removeprefix('W/') for t in if_none_match.split(',')):
+        response_cache.stats['not_modified'] += 1
+        return {'statusCode': 304, 'headers': FrozenHeaders(NOT_MODIFIED_HEADERS, ETag=etag), 'body': '', 'isBase64Encoded': False}
+    return {'statusCode': 200, 'headers': FrozenHeaders(CACHED_JSON_HEADERS, ETag=etag), 'body': body, 'isBase64Encoded': False}
+
+def cacheable_json_response(req, scope: str, key, payload) -> dict:
+    body = serialize(payload)
+    if not req.may_cache:
+        return cached_response(req, make_etag(body), body)
+    return cached_response(req, response_cache.set(scope, key, body), body)
+
+def runtime_stats() -> dict:
+    return {
+        'pool': get_db_pool().stats,
+        'responseCache': response_cache.stats,
+        'sessionCache': session_cache.stats,
+        'experience': experience_ledger.stats,
+        'flood': flood_guard.stats,
+        'replicas': dict(replicas.stats, lags=replicas.lags),
+        'coldStart': cold_start
+    }
+
+class Request:
+    '''Разобранное событие вызова; соединение из пула берётся только при первом обращении к cur.
+    Маршруты с replica=True читают с реплики, если она есть и клиент недавно не писал'''
+    __slots__ = ('event', 'method', 'params', 'action', 'headers', 'user', 'request_id', 'timings', 'error',
+                 'read_only', 'db_target', '_body', '_conn', '_cur', '_pool', '_primary')
+
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.action = self.params.get('action', '')
+        self.headers = event.get('headers') or {}
+        self.user = None
+        self.request_id = (event.get('requestContext') or {}).get('requestId') or os.urandom(8).hex()
+        self.timings = RequestTimings()
+        self.error = None
+        self.read_only = False
+        self.db_target = None
+        self._body = None
+        self._conn = None
+        self._cur = None
+        self._pool = None
+        self._primary = None
+
+    def header(self, name: str):
+        return self.headers.get(name) or self.headers.get(name.lower())
+
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            raw = self.event.get('body')
+            self._body = json.loads(raw) if raw else {}
+        return self._body
+
+    def last_write(self):
+        '''Время последней записи клиента (Unix-время) из LAST_WRITE_HEADER или None'''
+        try:
+            return float(self.header(LAST_WRITE_HEADER))
+        except (TypeError, ValueError):
+            return None
+
+    def source_ip(self):
+        identity = (self.event.get('requestContext') or {}).get('identity') or {}
+        return identity.get('sourceIp')
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            started = time.perf_counter()
+            routed = replicas.getconn(self.last_write()) if self.read_only and self.method == 'GET' else None
+            if routed:
+                index, self._pool, self._conn = routed
+                self.db_target = f'replica:{index}'
+            else:
+                self._pool = get_db_pool()
+                self._conn = self._pool.getconn()
+                self.db_target = 'primary'
+            self.timings.connect += time.perf_counter() - started
+        return self._conn
+
+    @property
+    def primary(self):
+        '''Соединение с основной базой для записей внутри читающего маршрута (например, свёртки лайков)'''
+        if self._conn is not None and not (self.db_target or '').startswith('replica'):
+            return self._conn
+        if self._conn is None and not self.read_only:
+            return self.conn
+        if self._primary is None:
+            started = time.perf_counter()
+            self._primary = get_db_connection()
+            self.timings.connect += time.perf_counter() - started
+        return self._primary
+
+    @property
+    def may_cache(self) -> bool:
+        '''Ответ реплики можно класть в кэш контейнера, только если последнее известное изменение старше
+        допустимого отставания: иначе в кэш попадёт состояние до изменения. Действия пакета не кэшируются вовсе:
+        они видят незафиксированные записи пакета, которые ещё могут откатиться'''
+        if isinstance(self._conn, BatchConnection):
+            return False
+        return not (self.db_target or '').startswith('replica') or time.monotonic() - invalidation_feed.changed_at > REPLICA_MAX_LAG
+
+    @property
+    def cur(self):
+        if self._cur is None:
+            self._cur = self.conn.cursor()
+        return self._cur
+
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+        if self._conn is not None and self._pool is not None:
+            self._pool.putconn(self._conn)
+        release_db_connection(self._primary)
+        self._conn = self._cur = self._pool = self._primary = None
+
+def log_request(req, status: int):
+    '''Одна структурированная строка лога на вызов'''
+    if not REQUEST_LOG:
+        return
+    entry = {'requestId': req.request_id, 'method': req.method, 'action': req.action, 'status': status}
+    if req.db_target:
+        entry['db'] = req.db_target
+    entry.update(req.timings.as_dict())
+    if req.timings.slow_queries:
+        entry['slowQueries'] = req.timings.slow_queries
+    if req.error:
+        entry['error'] = req.error
+    print(dumps(entry), flush=True)
+
+class BatchConnection:
+    '''Соединение пакетного вызова: commit обработчиков откладывается до конца пакета, rollback запрещён —
+    он отменил бы предыдущие действия пакета; остальное — как у настоящего'''
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        raise HTTPError(409, 'Action aborted the batch transaction')
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class Router:
+    '''Таблица маршрутов (метод, action) -> обработчик с общей обработкой ошибок и освобождением соединения.
+    С batch=True добавляется action batch: список действий в одном снимке и одной транзакции'''
+
+    def __init__(self, allow_methods: str, allow_headers: str, before=None, batch: bool = False):
+        self.routes = {}
+        self.unbatchable = {'batch'}
+        self.replica_routes = set()
+        self.before = before
+        self.options_headers = FrozenHeaders({
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': allow_methods,
+            'Access-Control-Allow-Headers': f'{allow_headers}, {LAST_WRITE_HEADER}'
+        })
+        # Статистика открыта, только если у функции нет авторизации; иначе она проходит через before
+        self.route('GET', 'runtime-stats', public=before is None)(lambda req: json_response(runtime_stats()))
+        self.route('GET', 'pool-stats', public=before is None)(lambda req: json_response({'pool': get_db_pool().stats}))
+        if batch:
+            # Авторизация before проверяется для каждого действия пакета, а не для самого пакета
+            self.route('POST', 'batch', public=True)(self.batch)
+
+    def route(self, method: str, action: str, public: bool = False, batchable: bool = True, replica: bool = False):
+        def register(fn):
+            self.routes[(method, action)] = (fn, public)
+            if not batchable:
+                self.unbatchable.add(action)
+            if replica:
+                self.replica_routes.add((method, action))
+            return fn
+        return register
+
+    def batch(self, req) -> dict:
+        '''Выполняет действия по порядку на одном соединении в транзакции REPEATABLE READ: все чтения видят один
+        снимок, записи фиксируются вместе. Первая ошибка откатывает пакет; конфликт сериализации — повтор пакета'''
+        actions = req.body.get('actions')
+        if not isinstance(actions, list) or not actions:
+            raise HTTPError(400, 'actions must be a non-empty list')
+        if len(actions) > BATCH_MAX_ACTIONS:
+            raise HTTPError(400, f'At most {BATCH_MAX_ACTIONS} actions per batch')
+        for item in actions:
+            if not isinstance(item, dict) or item.get('action') in self.unbatchable:
+                raise HTTPError(400, f"Action cannot be batched: {item.get('action') if isinstance(item, dict) else item}")
+
+        pg = psycopg()
+        for attempt in range(BATCH_RETRIES + 1):
+            try:
+                return self._run_batch(req, actions)
+            except pg.extensions.TransactionRollbackError:
+                req.conn.rollback()
+                if attempt == BATCH_RETRIES:
+                    raise HTTPError(409, 'Batch conflicted with concurrent writes, retry')
+                time.sleep(random.uniform(0, BATCH_RETRY_DELAY * 2 ** attempt))
+
+    def _run_batch(self, req, actions: list) -> dict:
+        req.cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        conn = BatchConnection(req.conn)
+        headers = {k: v for k, v in req.headers.items() if k.lower() != 'if-none-match'}
+        results = []
+        for index, item in enumerate(actions):
+            sub = Request({
+                'httpMethod': item.get('method', 'GET'),
+                'queryStringParameters': dict(item.get('params') or {}, action=item['action']),
+                'headers': headers
+            })
+            sub.request_id = f'{req.request_id}:{index}'
+            sub._body = item.get('body') or {}
+            sub._conn = conn
+            sub._cur = req.cur
+            try:
+                response = self.call(sub)
+            except HTTPError as e:
+                response = error_response(e.status, e.message, e.headers)
+            # Тела ответов уже сериализованы обработчиками и вставляются в пакет как есть
+            results.append(f'{{"action":{dumps(item["action"])},"status":{response["statusCode"]},"body":{response["body"] or "null"}}}')
+            if response['statusCode'] >= 400:
+                req.conn.rollback()
+                body = f'{{"error":"Batch action failed","failedIndex":{index},"results":[{",".join(results)}]}}'
+                return {'statusCode': response['statusCode'], 'headers': JSON_HEADERS, 'body': body, 'isBase64Encoded': False}
+        req.conn.commit()
+        return {'statusCode': 200, 'headers': JSON_HEADERS, 'body': f'{{"results":[{",".join(results)}]}}', 'isBase64Encoded': False}
+
+    def dispatch(self, event: dict) -> dict:
+        if event.get('httpMethod') == 'OPTIONS':
+            return {'statusCode': 200, 'headers': self.options_headers, 'body': '', 'isBase64Encoded': False}
+
+        req = Request(event)
+        token = current_timings.set(req.timings)
+        try:
+            response = self.handle(req)
+        finally:
+            req.close()
+            current_timings.reset(token)
+            if cold_start['first_response_ms'] is None:
+                cold_start['first_response_ms'] = round((time.perf_counter() - IMPORTED_AT) * 1000, 3)
+
+        headers = dict(response['headers'])
+        headers['Server-Timing'] = req.timings.server_timing()
+        headers['Timing-Allow-Origin'] = '*'
+        if req.method != 'GET' and response['statusCode'] < 400:
+            headers[LAST_WRITE_HEADER] = f'{time.time():.3f}'
+            exposed = headers.get('Access-Control-Expose-Headers')
+            headers['Access-Control-Expose-Headers'] = f'{exposed}, {LAST_WRITE_HEADER}' if exposed else LAST_WRITE_HEADER
+        response['headers'] = headers
+        log_request(req, response['statusCode'])
+        return response
+
+    def call(self, req) -> dict:
+        route = self.routes.get((req.method, req.action))
+        if route is None:
+            return {'statusCode': 404, 'headers': JSON_HEADERS, 'body': NOT_FOUND_BODY, 'isBase64Encoded': False}
+        fn, public = route
+        req.read_only = (req.method, req.action) in self.replica_routes
+        if self.before is not None and not public:
+            self.before(req)
+        return fn(req)
+
+    def handle(self, req) -> dict:
+        try:
+            return self.call(req)
+        except HTTPError as e:
+            return error_response(e.status, e.message, e.headers)
+        except Exception:
+            req.error = traceback.format_exc()
+            return json_response({'error': 'Internal server error', 'requestId': req.request_id}, 500)
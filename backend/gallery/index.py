@@ -0,0 +1,180 @@
+'''API галереи скриншотов Russian Town: метаданные изображений, лента, лайки и топ недели'''
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+from runtime import (
+    HTTPError, LikeCounter, Router, cacheable_json_response, cached_response, decode_cursor, encode_cursor,
+    json_response, page_limit, publish_response_change, refresh_caches, resolve_session, response_cache
+)
+
+GALLERY_PAGE_SIZE = 24
+GALLERY_MAX_PAGE_SIZE = 48
+TOP_PAGE_SIZE = 12
+TOP_MAX_PAGE_SIZE = 48
+IMAGE_MAX_DIMENSION = 10000
+URL_MAX_LENGTH = 500
+TITLE_MAX_LENGTH = 200
+GALLERY_COLUMNS = """
+    g.id, g.user_id, u.username, g.title, g.image_url, g.thumbnail_url, g.width, g.height, g.likes, g.created_at
+"""
+
+router = Router('GET, POST, OPTIONS', 'Content-Type, X-User-Token, If-None-Match')
+
+def current_week() -> date:
+    today = date.today()
+    return today - timedelta(days=today.weekday())
+
+def add_weekly_scores(cur, totals: dict):
+    '''Свёрнутые лайки добавляются к очкам текущей недели, так что топ читается по индексу без сортировки'''
+    cur.execute("""
+        INSERT INTO gallery_weekly_scores (week_start, gallery_id, score)
+        SELECT %s, id, delta FROM unnest(%s::int[], %s::int[]) AS t(id, delta)
+        ON CONFLICT (week_start, gallery_id)
+        DO UPDATE SET score = gallery_weekly_scores.score + EXCLUDED.score
+    """, (current_week(), list(totals), list(totals.values())))
+
+gallery_likes = LikeCounter('gallery', response_scope='gallery', on_fold=add_weekly_scores)
+
+def require_user(req) -> dict:
+    refresh_caches(req)
+    user = resolve_session(req, req.header('X-User-Token'))
+    if not user:
+        raise HTTPError(401, 'Session token required')
+    return user
+
+def parse_url(value, field: str, required: bool = True):
+    if not value:
+        if required:
+            raise HTTPError(400, f'{field} required')
+        return None
+    if len(value) > URL_MAX_LENGTH or urlsplit(value).scheme not in ('http', 'https'):
+        raise HTTPError(400, f'Invalid {field}')
+    return value
+
+def parse_dimension(value, field: str):
+    if value is None:
+        return None
+    try:
+        dimension = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f'Invalid {field}')
+    if not 0 < dimension <= IMAGE_MAX_DIMENSION:
+        raise HTTPError(400, f'{field} must be between 1 and {IMAGE_MAX_DIMENSION}')
+    return dimension
+
+# Сохранение метаданных загруженного изображения
+@router.route('POST', 'upload-metadata')
+def upload_metadata(req):
+    user = require_user(req)
+    image_url = parse_url(req.body.get('imageUrl'), 'imageUrl')
+    thumbnail_url = parse_url(req.body.get('thumbnailUrl'), 'thumbnailUrl', required=False)
+    width = parse_dimension(req.body.get('width'), 'width')
+    height = parse_dimension(req.body.get('height'), 'height')
+    title = (req.body.get('title') or '').strip()[:TITLE_MAX_LENGTH] or None
+
+    req.cur.execute("""
+        INSERT INTO gallery (user_id, image_url, thumbnail_url, width, height, title, description)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id, user_id, title, description, image_url, thumbnail_url, width, height, likes, created_at
+    """, (user['id'], image_url, thumbnail_url, width, height, title, req.body.get('description')))
+    image = req.cur.fetchone()
+    publish_response_change(req.cur, 'gallery')
+    req.conn.commit()
+
+    return json_response({'success': True, 'image': image})
+
+# Лента галереи (keyset-пагинация по created_at, id)
+@router.route('GET', 'list')
+def list_images(req):
+    cache_key = ('gallery', tuple(sorted(req.params.items())))
+    refresh_caches(req)
+    cached = response_cache.get('gallery', cache_key)
+    if cached:
+        return cached_response(req, *cached)
+
+    limit = page_limit(req.params, GALLERY_PAGE_SIZE, GALLERY_MAX_PAGE_SIZE)
+    cursor = decode_cursor(req.params.get('cursor'), 2)
+    conditions = []
+    query_params = []
+    if req.params.get('userId'):
+        conditions.append("g.user_id = %s")
+        try:
+            query_params.append(int(req.params['userId']))
+        except ValueError:
+            raise HTTPError(400, 'Invalid userId')
+    if cursor:
+        conditions.append("(g.created_at, g.id) < (%s, %s)")
+        query_params.extend(cursor)
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query_params.append(limit + 1)
+
+    gallery_likes.fold_if_due(req.conn)
+    req.cur.execute(f"""
+        SELECT {GALLERY_COLUMNS}
+        FROM gallery g
+        LEFT JOIN users u ON g.user_id = u.id
+        {where_sql}
+        ORDER BY g.created_at DESC, g.id DESC
+        LIMIT %s
+    """, query_params)
+
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return cacheable_json_response(req, 'gallery', cache_key, {'images': rows[:limit], 'nextCursor': next_cursor})
+
+# Топ недели по очкам популярности (keyset-пагинация по score, id)
+@router.route('GET', 'top')
+def top_week(req):
+    week = current_week()
+    cache_key = ('gallery-top', week, tuple(sorted(req.params.items())))
+    refresh_caches(req)
+    cached = response_cache.get('gallery', cache_key)
+    if cached:
+        return cached_response(req, *cached)
+
+    limit = page_limit(req.params, TOP_PAGE_SIZE, TOP_MAX_PAGE_SIZE)
+    cursor = decode_cursor(req.params.get('cursor'), 2)
+    cursor_sql = "AND (s.score, s.gallery_id) < (%s, %s)" if cursor else ""
+
+    gallery_likes.fold_if_due(req.conn)
+    req.cur.execute(f"""
+        SELECT {GALLERY_COLUMNS}, s.score
+        FROM gallery_weekly_scores s
+        JOIN gallery g ON g.id = s.gallery_id
+        LEFT JOIN users u ON g.user_id = u.id
+        WHERE s.week_start = %s {cursor_sql}
+        ORDER BY s.score DESC, s.gallery_id DESC
+        LIMIT %s
+    """, [week, *(cursor or []), limit + 1])
+
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['score'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return cacheable_json_response(req, 'gallery', cache_key, {
+        'weekStart': week, 'images': rows[:limit], 'nextCursor': next_cursor
+    })
+
+# Лайк изображения: один на пользователя, счётчик шардирован
+@router.route('POST', 'like')
+def like_image(req):
+    user = require_user(req)
+    image_id = req.body.get('imageId')
+
+    req.cur.execute("""
+        INSERT INTO gallery_likes (gallery_id, user_id)
+        SELECT id, %s FROM gallery WHERE id = %s
+        ON CONFLICT DO NOTHING
+        RETURNING gallery_id
+    """, (user['id'], image_id))
+    if not req.cur.fetchone():
+        req.cur.execute("SELECT 1 FROM gallery WHERE id = %s", (image_id,))
+        if not req.cur.fetchone():
+            raise HTTPError(404, 'Image not found')
+        raise HTTPError(409, 'Already liked')
+
+    likes = gallery_likes.increment(req.cur, image_id)
+    req.conn.commit()
+
+    gallery_likes.fold_if_due(req.conn)
+    return json_response({'success': True, 'likes': likes})
+
+def handler(event: dict, context) -> dict:
+    return router.dispatch(event)
@@ -0,0 +1,171 @@
+'''API новостей Russian Town: лента с готовыми снимками страниц и публикация новостей'''
+import os
+from runtime import (
+    HTTPError, Router, cacheable_json_response, cached_response, decode_cursor, dumps, encode_cursor,
+    invalidation_feed, json_response, make_etag, page_limit, publish_invalidation, refresh_caches,
+    resolve_session, response_cache
+)
+
+NEWS_PAGE_SIZE = 20
+NEWS_MAX_PAGE_SIZE = 50
+NEWS_SNAPSHOT_PAGES = int(os.environ.get('NEWS_SNAPSHOT_PAGES', '5'))
+NEWS_TITLE_MAX_LENGTH = 200
+NEWS_COLUMNS = """
+    n.id, n.title, n.content, n.image_url, n.created_at, n.author_id, u.username as author_name
+"""
+
+router = Router('GET, POST, OPTIONS', 'Content-Type, X-User-Token, If-None-Match')
+
+class FeedSnapshots:
+    '''Первые страницы ленты в виде готовых ответов, ключ — курсор страницы ('' для первой).
+    Пересобираются в транзакции публикации; остальные контейнеры узнают о пересборке из журнала инвалидаций'''
+
+    def __init__(self):
+        self.pages = None
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'rebuilds': 0}
+
+    def drop(self, _key=None):
+        self.pages = None
+
+    def get(self, req, cursor: str):
+        if self.pages is None:
+            self.load(req)
+        page = self.pages.get(cursor)
+        self.stats['hits' if page else 'misses'] += 1
+        return page
+
+    def load(self, req):
+        req.cur.execute("SELECT cursor, etag, body FROM news_feed_snapshots")
+        rows = req.cur.fetchall()
+        self.stats['loads'] += 1
+        if rows:
+            self.pages = {r['cursor']: (r['etag'], r['body']) for r in rows}
+        else:
+            pages = self.rebuild(req.cur)
+            req.conn.commit()
+            self.pages = pages
+
+    def rebuild(self, cur) -> dict:
+        '''Собирает NEWS_SNAPSHOT_PAGES страниц одним запросом и заменяет сохранённые снимки;
+        страницы ставятся в память вызывающим кодом после коммита'''
+        cur.execute("LOCK TABLE news_feed_snapshots IN EXCLUSIVE MODE")
+        cur.execute(f"""
+            SELECT {NEWS_COLUMNS}
+            FROM news n
+            LEFT JOIN users u ON n.author_id = u.id
+            ORDER BY n.created_at DESC, n.id DESC
+            LIMIT %s
+        """, (NEWS_PAGE_SIZE * NEWS_SNAPSHOT_PAGES + 1,))
+        rows = cur.fetchall()
+
+        pages = {}
+        cursor = ''
+        for start in range(0, NEWS_PAGE_SIZE * NEWS_SNAPSHOT_PAGES, NEWS_PAGE_SIZE):
+            page = rows[start:start + NEWS_PAGE_SIZE]
+            next_cursor = encode_cursor(page[-1]['created_at'], page[-1]['id']) if len(rows) > start + NEWS_PAGE_SIZE else None
+            body = dumps({'news': page, 'nextCursor': next_cursor})
+            pages[cursor] = (make_etag(body), body)
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+
+        cur.execute("DELETE FROM news_feed_snapshots")
+        cur.execute("""
+            INSERT INTO news_feed_snapshots (cursor, etag, body)
+            SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::text[])
+        """, (list(pages), [p[0] for p in pages.values()], [p[1] for p in pages.values()]))
+        self.stats['rebuilds'] += 1
+        return pages
+
+feed_snapshots = FeedSnapshots()
+invalidation_feed.subscribe('news-feed', feed_snapshots.drop)
+
+# Лента новостей (keyset-пагинация по created_at, id; первые страницы отдаются из снимков)
+@router.route('GET', 'list')
+def list_news(req):
+    limit = page_limit(req.params, NEWS_PAGE_SIZE, NEWS_MAX_PAGE_SIZE)
+    cursor = req.params.get('cursor') or ''
+    refresh_caches(req)
+    if limit == NEWS_PAGE_SIZE and NEWS_SNAPSHOT_PAGES:
+        page = feed_snapshots.get(req, cursor)
+        if page:
+            return cached_response(req, *page)
+
+    conditions = ""
+    query_params = []
+    position = decode_cursor(cursor, 2)
+    if position:
+        conditions = "WHERE (n.created_at, n.id) < (%s, %s)"
+        query_params.extend(position)
+    query_params.append(limit + 1)
+
+    req.cur.execute(f"""
+        SELECT {NEWS_COLUMNS}
+        FROM news n
+        LEFT JOIN users u ON n.author_id = u.id
+        {conditions}
+        ORDER BY n.created_at DESC, n.id DESC
+        LIMIT %s
+    """, query_params)
+    rows = req.cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return json_response({'news': rows[:limit], 'nextCursor': next_cursor})
+
+# Одна новость
+@router.route('GET', 'get')
+def get_news(req):
+    try:
+        news_id = int(req.params.get('id'))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'id required')
+    cached = response_cache.get('news', ('news', news_id))
+    if cached:
+        return cached_response(req, *cached)
+
+    req.cur.execute(f"""
+        SELECT {NEWS_COLUMNS}
+        FROM news n
+        LEFT JOIN users u ON n.author_id = u.id
+        WHERE n.id = %s
+    """, (news_id,))
+    item = req.cur.fetchone()
+    if not item:
+        raise HTTPError(404, 'News not found')
+    return cacheable_json_response(req, 'news', ('news', news_id), {'news': item})
+
+# Публикация новости (только администрация) с пересборкой снимков ленты
+@router.route('POST', 'create')
+def create_news(req):
+    refresh_caches(req)
+    author = resolve_session(req, req.header('X-User-Token'))
+    if not author:
+        raise HTTPError(401, 'Session token required')
+    if not author['admin_role']:
+        raise HTTPError(403, 'Only administration can publish news')
+
+    title = (req.body.get('title') or '').strip()
+    content = (req.body.get('content') or '').strip()
+    if not title or not content:
+        raise HTTPError(400, 'Title and content required')
+    if len(title) > NEWS_TITLE_MAX_LENGTH:
+        raise HTTPError(400, f'Title is longer than {NEWS_TITLE_MAX_LENGTH} characters')
+
+    req.cur.execute(
+        "INSERT INTO news (title, content, author_id, image_url) VALUES (%s, %s, %s, %s) RETURNING id, title, content, image_url, created_at, author_id",
+        (title, content, author['id'], req.body.get('imageUrl'))
+    )
+    item = req.cur.fetchone()
+    pages = feed_snapshots.rebuild(req.cur)
+    publish_invalidation(req.cur, 'news-feed', [item['id']])
+    req.conn.commit()
+    feed_snapshots.pages = pages
+
+    return json_response({'success': True, 'news': item})
+
+# Статистика снимков ленты
+@router.route('GET', 'feed-stats')
+def feed_stats(req):
+    return json_response({'snapshots': feed_snapshots.stats, 'pages': len(feed_snapshots.pages or {})})
+
+def handler(event: dict, context) -> dict:
+    return router.dispatch(event)
@@ -0,0 +1,396 @@
+'''Нагрузочный прогон облачных функций Russian Town по их tests.json.
+
+Создаёт одноразовую базу на указанном сервере PostgreSQL, применяет db_migrations,
+заполняет её реалистичными объёмами и вызывает handler каждой функции в процессе,
+параллельно из нескольких потоков. Для каждого сценария считает пропускную способность,
+p50/p95/p99 задержки и число SQL-запросов на вызов, затем сравнивает с baseline.json.
+
+    python bench/benchmark.py --dsn "host=localhost user=postgres dbname=postgres"
+    python bench/benchmark.py --dsn ... --update-baseline
+
+Код выхода 1, если какой-то сценарий хуже базовой линии больше допустимого.
+'''
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+import psycopg2
+import psycopg2.extensions
+
+from sync_runtime import runtime_drift
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND = ROOT / 'backend'
+MIGRATIONS = ROOT / 'db_migrations'
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+BASELINE_NO_CACHE = Path(__file__).resolve().parent / 'baseline-no-cache.json'
+FUNCTIONS = ('auth', 'forum', 'admin', 'news', 'gallery')
+
+# V0002 записывает хеш, не совпадающий с паролем из auth/tests.json, поэтому прогон выставляет его заново
+ROOT_ADMIN_PASSWORD = 'wagnera_tut$45$'
+# Поля, которые должны быть уникальны при повторении сценария, иначе второй вызов получит 409;
+# номер процесса в суффиксе разводит повторные прогоны по одной базе (--reuse)
+UNIQUE_BODY_FIELDS = {('auth', 'register'): ('username',)}
+
+# Размер синтетического словаря: тематическое слово из WORDS стоит примерно на каждом сотом месте,
+# чтобы поиск находил доли процента строк, а не почти все подряд
+VOCABULARY_SIZE = 20000
+WORDS = [
+    'правила', 'фракция', 'сервер', 'машина', 'полиция', 'армия', 'набор', 'дорога', 'город', 'мост',
+    'грузовик', 'вертолёт', 'гонка', 'карта', 'патруль', 'генерал', 'ивент', 'постройка', 'сборка', 'танк',
+    'самолёт', 'поезд', 'станция', 'штаб', 'мэрия', 'больница', 'скорая', 'пожарные', 'тюнинг', 'ДПС',
+    'приказ', 'звание', 'рапорт', 'жалоба', 'модератор', 'админ', 'бан', 'мут', 'дискорд', 'голосование'
+]
+
+SEED_SQL = """
+    UPDATE users SET password_hash = %(root_password_hash)s WHERE username = 'TOURIST_WAGNERA';
+
+    INSERT INTO users (username, password_hash, status, rank_level, experience, faction_id,
+                       is_banned, is_muted, created_at)
+    SELECT 'bench_user_' || g,
+           md5(g::text),
+           'Новичок',
+           1 + g %% 10,
+           (g * 7919) %% 50000,
+           CASE WHEN g %% 3 = 0 THEN NULL ELSE f.ids[1 + g %% array_length(f.ids, 1)] END,
+           g %% 97 = 0,
+           g %% 53 = 0,
+           NOW() - g * INTERVAL '1 minute'
+    FROM generate_series(1::bigint, %(users)s) g,
+         (SELECT array_agg(id ORDER BY id) as ids FROM factions) f;
+
+    INSERT INTO user_roles (user_id, role_id)
+    SELECT u.id, r.ids[1 + u.id %% array_length(r.ids, 1)]
+    FROM users u, (SELECT array_agg(id ORDER BY id) as ids FROM roles) r
+    WHERE u.username LIKE 'bench_user_%%'
+    ON CONFLICT DO NOTHING;
+
+    CREATE TEMP TABLE bench_users AS
+    SELECT array_agg(id ORDER BY id) as ids FROM users;
+
+    INSERT INTO forum_posts (user_id, title, content, category, likes, created_at)
+    SELECT u.ids[1 + (g * 31) %% array_length(u.ids, 1)],
+           'Тема ' || g || ': ' || (%(words)s::text[])[1 + g %% %(word_count)s],
+           (SELECT string_agg(CASE WHEN (g * 7 + k * 13) %% 100 = 0
+                                   THEN (%(words)s::text[])[1 + (g + k) %% %(word_count)s]
+                                   ELSE 'слово' || (g * 7919 + k * 104729) %% %(vocabulary)s END, ' ')
+            FROM generate_series(1, 20 + g %% 60) k),
+           (ARRAY['общее', 'фракции', 'жалобы', 'ивенты'])[1 + g %% 4],
+           g %% 40,
+           NOW() - g * INTERVAL '20 seconds'
+    FROM generate_series(1::bigint, %(posts)s) g, bench_users u;
+
+    INSERT INTO forum_comments (post_id, user_id, content, created_at)
+    SELECT 1 + (g * 131) %% %(posts)s,
+           u.ids[1 + (g * 17) %% array_length(u.ids, 1)],
+           (SELECT string_agg(CASE WHEN (g * 11 + k * 5) %% 100 = 0
+                                   THEN (%(words)s::text[])[1 + (g + k) %% %(word_count)s]
+                                   ELSE 'слово' || (g * 6007 + k * 104723) %% %(vocabulary)s END, ' ')
+            FROM generate_series(1, 5 + g %% 25) k),
+           NOW() - g * INTERVAL '5 seconds'
+    FROM generate_series(1::bigint, %(comments)s) g, bench_users u;
+
+    UPDATE forum_posts p
+    SET comment_count = COALESCE(c.comments, 0), last_activity_at = GREATEST(p.created_at, c.last_comment_at)
+    FROM forum_posts p2
+    LEFT JOIN (
+        SELECT post_id, COUNT(*) as comments, MAX(created_at) as last_comment_at
+        FROM forum_comments
+        GROUP BY post_id
+    ) c ON c.post_id = p2.id
+    WHERE p2.id = p.id;
+
+    UPDATE users u
+    SET rank_level = (SELECT MAX(r.level) FROM rank_levels r WHERE r.min_experience <= u.experience);
+
+    INSERT INTO leaderboard_counts (faction_id, width, value, users)
+    SELECT s.faction_id, w.width, u.experience / w.width, COUNT(*)
+    FROM users u
+    CROSS JOIN LATERAL (VALUES (0), (u.faction_id)) s(faction_id)
+    CROSS JOIN (VALUES (1), (100)) w(width)
+    WHERE u.experience > 0 AND s.faction_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (faction_id, width, value) DO UPDATE SET users = EXCLUDED.users;
+
+    UPDATE factions f
+    SET member_count = COALESCE(c.members, 0), admin_count = COALESCE(c.admins, 0), banned_count = COALESCE(c.banned, 0)
+    FROM factions f2
+    LEFT JOIN (
+        SELECT faction_id,
+               COUNT(*) as members,
+               COUNT(*) FILTER (WHERE admin_role IS NOT NULL) as admins,
+               COUNT(*) FILTER (WHERE is_banned) as banned
+        FROM users
+        GROUP BY faction_id
+    ) c ON c.faction_id = f2.id
+    WHERE f2.id = f.id;
+
+    INSERT INTO sessions (token_hash, user_id, created_at, last_seen_at, expires_at, revoked_at)
+    SELECT md5('session' || u.id) || md5(u.id::text), u.id, NOW(), NOW(),
+           NOW() + INTERVAL '30 days', CASE WHEN u.id %% 4 = 0 THEN NOW() END
+    FROM users u
+    WHERE u.id %% 5 = 0;
+
+    INSERT INTO gallery (user_id, image_url, thumbnail_url, width, height, title, likes, created_at)
+    SELECT u.ids[1 + (g * 13) %% array_length(u.ids, 1)],
+           'https://cdn.example.com/shots/' || g || '.png',
+           'https://cdn.example.com/thumbs/' || g || '.webp',
+           1920, 1080,
+           'Скриншот ' || g,
+           g %% 50,
+           NOW() - g * INTERVAL '1 minute'
+    FROM generate_series(1::bigint, %(images)s) g, bench_users u;
+
+    INSERT INTO gallery_weekly_scores (week_start, gallery_id, score)
+    SELECT date_trunc('week', CURRENT_DATE)::date, id, likes
+    FROM gallery
+    WHERE likes > 0 AND created_at > NOW() - INTERVAL '7 days';
+
+    INSERT INTO forum_events (kind, post_id, data, created_at)
+    SELECT 'like', 1 + g %% %(posts)s, json_build_object('post_id', 1 + g %% %(posts)s, 'likes', g %% 50),
+           NOW() - (%(events)s - g) * INTERVAL '50 milliseconds'
+    FROM generate_series(1::bigint, %(events)s) g;
+
+    DROP TABLE bench_users;
+"""
+
+# Число запросов берётся из заголовка Server-Timing, который выставляет runtime
+QUERY_COUNT = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+
+def create_database(admin_dsn: str, name: str) -> str:
+    conn = psycopg2.connect(admin_dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+        cur.execute(f'CREATE DATABASE "{name}"')
+    conn.close()
+    return psycopg2.extensions.make_dsn(admin_dsn, dbname=name)
+
+def drop_database(admin_dsn: str, name: str):
+    conn = psycopg2.connect(admin_dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    conn.close()
+
+def migrate_and_seed(dsn: str, users: int, posts: int, comments: int):
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        for migration in sorted(MIGRATIONS.glob('V*.sql')):
+            cur.execute(migration.read_text())
+        conn.commit()
+
+        started = time.perf_counter()
+        cur.execute(SEED_SQL, {
+            'users': users, 'posts': posts, 'comments': comments, 'images': max(posts // 25, 1),
+            'events': max(posts // 10, 1),
+            'words': WORDS, 'word_count': len(WORDS), 'vocabulary': VOCABULARY_SIZE,
+            'root_password_hash': hashlib.sha256(ROOT_ADMIN_PASSWORD.encode()).hexdigest()
+        })
+        conn.commit()
+        print(f'seeded {users} users, {posts} posts, {comments} comments in {time.perf_counter() - started:.1f}s')
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('VACUUM ANALYZE')
+    conn.close()
+
+def load_function(name: str):
+    '''Импортирует index.py функции вместе с её собственной копией runtime.py'''
+    path = str(BACKEND / name)
+    sys.path.insert(0, path)
+    sys.modules.pop('runtime', None)
+    try:
+        spec = importlib.util.spec_from_file_location(f'bench_{name}_index', Path(path) / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        runtime = sys.modules.pop('runtime')
+    finally:
+        sys.path.remove(path)
+    return module, runtime
+
+def load_scenarios(functions) -> list:
+    scenarios = []
+    for name in functions:
+        specs = json.loads((BACKEND / name / 'tests.json').read_text())['tests']
+        for spec in specs:
+            params = dict(parse_qsl(urlsplit(spec['path']).query))
+            scenarios.append({
+                'key': f"{name} {spec['method']} {params.get('action', '')} | {spec['name']}",
+                'function': name,
+                'method': spec['method'],
+                'params': params,
+                'headers': spec.get('headers', {}),
+                'body': spec.get('body'),
+                'expected_status': spec.get('expectedStatus', 200)
+            })
+    return scenarios
+
+def build_event(scenario: dict, seq: int) -> dict:
+    body = scenario['body']
+    unique_fields = UNIQUE_BODY_FIELDS.get((scenario['function'], scenario['params'].get('action')), ())
+    if body is not None and unique_fields:
+        body = dict(body, **{f: f'{body[f]}_{os.getpid()}_{seq}' for f in unique_fields})
+    return {
+        'httpMethod': scenario['method'],
+        'queryStringParameters': dict(scenario['params']),
+        'headers': dict(scenario['headers']),
+        'body': json.dumps(body, ensure_ascii=False) if body is not None else None
+    }
+
+def percentile(sorted_values: list, pct: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def run_scenario(handler, scenario: dict, requests: int, concurrency: int, warmup: int, seq_start: int) -> dict:
+    def invoke(seq: int):
+        started = time.perf_counter()
+        response = handler(build_event(scenario, seq), None)
+        elapsed = (time.perf_counter() - started) * 1000
+        queries = QUERY_COUNT.search(response['headers'].get('Server-Timing', ''))
+        return elapsed, int(queries.group(1)) if queries else 0, response['statusCode']
+
+    for seq in range(seq_start, seq_start + warmup):
+        invoke(seq)
+
+    seq_start += warmup
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(invoke, range(seq_start, seq_start + requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(r[0] for r in results)
+    errors = sum(1 for r in results if r[2] != scenario['expected_status'])
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': round(requests / wall, 1),
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'mean': round(statistics.fmean(latencies), 3),
+        'queries_per_request': round(statistics.fmean(r[1] for r in results), 2),
+        # Доля ответов без единого SQL-запроса, то есть из кэшей процесса; путь до БД меряет --no-cache
+        'cached_share': round(sum(1 for r in results if r[1] == 0) / requests, 2)
+    }
+
+def scenario_function(key: str) -> str:
+    return key.split(' ', 1)[0]
+
+def compare(results: dict, baseline: dict, functions, tolerance: float) -> list:
+    '''Возвращает список регрессий относительно базовой линии. Сценарий без записи в базовой линии и запись
+    без сценария в tests.json прогнанных функций тоже считаются ошибкой: иначе они молча не проверяются'''
+    regressions = [
+        f'{key}: in baseline but not in tests.json; re-record with --update-baseline'
+        for key in baseline if scenario_function(key) in functions and key not in results
+    ]
+    for key, current in results.items():
+        if current['errors']:
+            regressions.append(f"{key}: {current['errors']} responses with unexpected status")
+        base = baseline.get(key)
+        if not base:
+            regressions.append(f'{key}: no baseline entry; record one with --update-baseline')
+            continue
+        if current['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {current['p95']} ms > baseline {base['p95']} ms")
+        if current['throughput'] < base['throughput'] / (1 + tolerance):
+            regressions.append(f"{key}: throughput {current['throughput']} rps < baseline {base['throughput']} rps")
+        if current['queries_per_request'] > base['queries_per_request']:
+            regressions.append(
+                f"{key}: {current['queries_per_request']} queries per request > baseline {base['queries_per_request']}"
+            )
+    return regressions
+
+def print_table(results: dict):
+    print(f"{'scenario':<70} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'q/req':>6} {'cached':>6} {'err':>5}")
+    for key, r in results.items():
+        print(f"{key[:70]:<70} {r['throughput']:>8} {r['p50']:>8} {r['p95']:>8} {r['p99']:>8} "
+              f"{r['queries_per_request']:>6} {r['cached_share']:>6} {r['errors']:>5}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True, help='DSN сервера, на котором можно создать одноразовую базу')
+    parser.add_argument('--database', default=f'rt_bench_{os.getpid()}')
+    parser.add_argument('--reuse', action='store_true', help='не создавать базу, а прогнать по уже заполненной --database')
+    parser.add_argument('--keep', action='store_true', help='не удалять базу после прогона')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--posts', type=int, default=500_000)
+    parser.add_argument('--comments', type=int, default=500_000)
+    parser.add_argument('--functions', nargs='+', default=list(FUNCTIONS), choices=FUNCTIONS)
+    parser.add_argument('--requests', type=int, default=500, help='вызовов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--no-cache', action='store_true', help='отключить кэши ответов и профилей, чтобы мерить путь до БД')
+    parser.add_argument('--log', action='store_true', help='печатать структурированный лог каждого вызова')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимое ухудшение p95 и rps')
+    parser.add_argument('--baseline', type=Path, help='по умолчанию baseline.json или baseline-no-cache.json при --no-cache')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', type=Path, help='сохранить результаты в JSON')
+    args = parser.parse_args()
+    args.baseline = args.baseline or (BASELINE_NO_CACHE if args.no_cache else BASELINE)
+    drift = runtime_drift()
+    if drift:
+        print(f"runtime.py differs from backend/runtime.py in {', '.join(p.parent.name for p in drift)}; run python bench/sync_runtime.py")
+        return 1
+    if not args.update_baseline and not args.baseline.exists():
+        print(f'no baseline at {args.baseline}; record one with --update-baseline')
+        return 1
+
+    try:
+        if args.reuse:
+            dsn = psycopg2.extensions.make_dsn(args.dsn, dbname=args.database)
+        else:
+            dsn = create_database(args.dsn, args.database)
+            migrate_and_seed(dsn, args.users, args.posts, args.comments)
+
+        os.environ['DATABASE_URL'] = dsn
+        os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+        os.environ.setdefault('REQUEST_LOG', '1' if args.log else '0')
+        # Сценарии повторяют одни и те же запросы от одного клиента сотни раз — ограничитель частоты их бы отсёк
+        os.environ.setdefault('FLOOD_CONTROL', '0')
+        if args.no_cache:
+            os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+            os.environ['PROFILE_CACHE_SIZE'] = '0'
+            os.environ['NEWS_SNAPSHOT_PAGES'] = '0'
+
+        handlers = {name: load_function(name) for name in args.functions}
+        results = {}
+        seq = 0
+        for scenario in load_scenarios(args.functions):
+            module, _ = handlers[scenario['function']]
+            results[scenario['key']] = run_scenario(
+                module.handler, scenario, args.requests, args.concurrency, args.warmup, seq
+            )
+            seq += args.requests + args.warmup
+    finally:
+        if not args.keep and not args.reuse:
+            drop_database(args.dsn, args.database)
+
+    print_table(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, ensure_ascii=False, indent=2))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.update_baseline:
+        # Записи функций, не вошедших в --functions, остаются прежними
+        kept = {key: value for key, value in baseline.items() if scenario_function(key) not in args.functions}
+        args.baseline.write_text(json.dumps({**kept, **results}, ensure_ascii=False, indent=2) + '\n')
+        print(f'baseline written to {args.baseline}')
+        return 0
+
+    regressions = compare(results, baseline, args.functions, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+'''Проверка планов запросов всех обработчиков на заполненной базе.
+
+Вызывает каждый маршрут auth, forum и admin хотя бы один раз с SLOW_QUERY_MS=0: runtime
+тогда пишет EXPLAIN каждого выполненного запроса в структурированный лог вызова. Планы
+проверяются на последовательное сканирование больших таблиц и явную сортировку.
+Маршруты с replica=True читают через соединение только для чтения к той же базе,
+поэтому запись на реплику падает так же, как на настоящем standby.
+
+    python bench/plans.py --dsn "host=localhost user=postgres dbname=postgres"
+
+Код выхода 1, если найден такой план или у маршрута нет проверочного вызова.
+'''
+import argparse
+import io
+import json
+import os
+import re
+import sys
+from contextlib import redirect_stdout
+
+import psycopg2.extensions
+
+from benchmark import FUNCTIONS, ROOT_ADMIN_PASSWORD, create_database, drop_database, load_function, migrate_and_seed
+from sync_runtime import runtime_drift
+
+# Таблицы, растущие вместе с сообществом; маленькие справочники (roles, factions, admin_codes) читаются целиком
+LARGE_TABLES = (
+    'users', 'forum_posts', 'forum_comments', 'forum_events', 'sessions', 'user_roles', 'gallery', 'gallery_likes'
+)
+SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+SORT = re.compile(r'^\s*(->\s+)?(Incremental )?Sort\s+\(.*rows=(\d+)')
+# Сортировка пары ролей пользователя или журнала инвалидаций безвредна; ловим сортировки, растущие с данными
+SORT_ROW_LIMIT = 1000
+# Релевантность поиска не берётся из индекса; сортировка по ts_rank прямо под Limit — top-N с постоянной памятью
+RANK_SORT_KEY = re.compile(r'^\s*Sort Key: \(*ts_rank\(')
+LIMIT = re.compile(r'^\s*(->\s+)?Limit\s')
+
+# Проверочные вызовы; {token} и {user_id} берутся из ответа первой регистрации, {admin_token} — из входа
+# главного админа, {run} отличает повторные прогоны
+CASES = [
+    ('auth', 'POST', 'register', {}, {'username': 'plan_check_{run}', 'password': 'plan-check'}, {}),
+    ('auth', 'POST', 'login', {}, {'username': 'plan_check_{run}', 'password': 'plan-check'}, {}),
+    ('auth', 'POST', 'register', {}, {'username': 'plan_check_faction_{run}', 'password': 'plan-check', 'factionId': 1}, {}),
+    ('auth', 'GET', 'session', {}, None, {'X-User-Token': '{token}'}),
+    ('auth', 'GET', 'profile', {'userId': '{user_id}'}, None, {}),
+    ('auth', 'GET', 'profiles', {'userIds': '1,2,3,{user_id}'}, None, {}),
+    ('auth', 'PUT', 'update-profile', {}, {'customStatus': 'plans'}, {'X-User-Token': '{token}'}),
+    ('auth', 'POST', 'logout', {}, None, {'X-User-Token': '{token}'}),
+    ('auth', 'POST', 'login', {}, {'username': 'TOURIST_WAGNERA', 'password': ROOT_ADMIN_PASSWORD}, {}),
+    ('auth', 'GET', 'leaderboard', {}, None, {}),
+    ('auth', 'GET', 'leaderboard', {'factionId': '1', 'userId': '{user_id}'}, None, {}),
+    ('auth', 'GET', 'leaderboard', {'userId': '2000', 'cursor': 'WzI1MDAwLDBd'}, None, {}),
+    ('auth', 'POST', 'batch', {}, {'actions': [{'action': 'profiles', 'params': {'userIds': '1,2,{user_id}'}}]}, {}),
+    ('forum', 'GET', 'posts', {}, None, {}),
+    ('forum', 'GET', 'posts', {'category': 'фракции', 'excerpt': '1'}, None, {}),
+    ('forum', 'GET', 'posts', {'cursor': '{posts_cursor}'}, None, {}),
+    ('forum', 'GET', 'posts', {'sort': 'hot'}, None, {}),
+    ('forum', 'GET', 'posts', {'sort': 'hot', 'category': 'фракции', 'cursor': 'WyJob3QiLDEwMDAwMC4wLDEwMDAwMDBd'}, None, {}),
+    ('forum', 'GET', 'posts', {'sort': 'active'}, None, {}),
+    ('forum', 'GET', 'posts', {'sort': 'active', 'category': 'общее'}, None, {}),
+    ('forum', 'GET', 'timeline', {}, None, {}),
+    ('forum', 'GET', 'timeline', {'userId': '{user_id}', 'limit': '100'}, None, {}),
+    ('forum', 'GET', 'timeline', {'cursor': 'W1siMjAyNi0wMS0wMVQwMDowMDowMCIsMTAwMDAwMF0sbnVsbCxmYWxzZV0='}, None, {}),
+    ('forum', 'GET', 'search', {'q': 'правила'}, None, {}),
+    ('forum', 'POST', 'create-post', {}, {'userId': '{user_id}', 'title': 'План', 'content': 'Проверка'}, {}),
+    ('forum', 'GET', 'comments', {'postId': '1000'}, None, {}),
+    ('forum', 'POST', 'add-comment', {}, {'userId': '{user_id}', 'postId': 1000, 'content': 'Проверка'}, {}),
+    ('forum', 'POST', 'like-post', {}, {'postId': 1000}, {}),
+    ('forum', 'GET', 'events', {'cursor': 'WzAsMF0=', 'wait': '0'}, None, {}),
+    ('forum', 'GET', 'events', {'cursor': 'WzAsMF0=', 'postId': '1000', 'wait': '0'}, None, {}),
+    ('forum', 'GET', 'events', {'wait': '0'}, None, {}),
+    ('forum', 'GET', 'events-stats', {}, None, {}),
+    ('forum', 'POST', 'batch', {}, {'actions': [
+        {'action': 'posts', 'params': {'sort': 'active', 'limit': '10'}},
+        {'action': 'comments', 'params': {'postId': '1000'}},
+        {'action': 'like-post', 'method': 'POST', 'body': {'postId': 1000}}
+    ]}, {}),
+    ('admin', 'GET', 'users', {}, None, {}),
+    ('admin', 'GET', 'users', {}, None, {'X-User-Token': '{admin_token}'}),
+    ('admin', 'GET', 'users', {'sort': 'experience', 'limit': '100'}, None, {}),
+    ('admin', 'GET', 'users', {'sort': 'username', 'order': 'asc'}, None, {}),
+    ('admin', 'GET', 'users', {'factionId': '1'}, None, {}),
+    ('admin', 'GET', 'users', {'isBanned': 'true'}, None, {}),
+    ('admin', 'GET', 'users', {'isMuted': 'true'}, None, {}),
+    ('admin', 'GET', 'users', {'adminRole': 'старший администратор'}, None, {}),
+    ('admin', 'GET', 'users', {'usernamePrefix': 'bench_user_42'}, None, {}),
+    ('admin', 'GET', 'users', {'export': 'csv'}, None, {}),
+    ('admin', 'GET', 'users', {'export': 'ndjson', 'isBanned': 'true', 'cursor': 'WyJleHBvcnQiLDUwMDAwXQ=='}, None, {}),
+    ('admin', 'GET', 'roles', {}, None, {}),
+    ('admin', 'GET', 'factions', {}, None, {}),
+    ('admin', 'GET', 'faction-roster', {'factionId': '1'}, None, {}),
+    ('admin', 'GET', 'faction-roster', {'factionId': '2', 'limit': '200', 'cursor': 'WzI1MDAwLDBd'}, None, {}),
+    ('admin', 'POST', 'ban', {}, {'userId': 2000}, {}),
+    ('admin', 'POST', 'mute', {}, {'userId': 2001}, {}),
+    ('admin', 'PUT', 'update-status', {}, {'userId': 2002, 'status': 'Ветеран'}, {}),
+    ('admin', 'POST', 'assign-faction', {}, {'userId': 2003, 'factionId': 1}, {}),
+    ('admin', 'POST', 'assign-role', {}, {'userId': 2004, 'roleId': 1}, {}),
+    ('admin', 'POST', 'grant-experience', {}, {'userId': 2005, 'amount': 150, 'reason': 'plans'}, {}),
+    ('admin', 'POST', 'bulk-ban', {}, {'userIds': [3000, 3001, 3002]}, {}),
+    ('admin', 'POST', 'bulk-mute', {}, {'userIds': [3003, 3004]}, {}),
+    ('admin', 'POST', 'bulk-update-status', {}, {'userIds': [3005, 3006], 'status': 'Ветеран'}, {}),
+    ('admin', 'POST', 'bulk-assign-faction', {}, {'userIds': [3007, 3008], 'factionId': 2}, {}),
+    ('admin', 'POST', 'bulk-assign-role', {}, {'assignments': [{'userId': 3009, 'roleId': 2}]}, {}),
+    ('admin', 'POST', 'create-role', {}, {'name': 'Проверка планов {run}'}, {}),
+    ('admin', 'POST', 'rotate-code', {}, {'code': 'plan-check-{run}'}, {}),
+    ('admin', 'GET', 'auth-stats', {}, None, {}),
+    ('admin', 'GET', 'runtime-stats', {}, None, {}),
+    ('admin', 'GET', 'pool-stats', {}, None, {}),
+    ('news', 'POST', 'create', {}, {'title': 'Проверка планов', 'content': 'Текст'}, {'X-User-Token': '{admin_token}'}),
+    ('news', 'GET', 'list', {}, None, {}),
+    ('news', 'GET', 'list', {'limit': '7'}, None, {}),
+    ('news', 'GET', 'get', {'id': '1'}, None, {}),
+    ('news', 'GET', 'feed-stats', {}, None, {}),
+    ('gallery', 'POST', 'upload-metadata', {}, {'imageUrl': 'https://cdn.example.com/plan.png', 'width': 640, 'height': 360},
+     {'X-User-Token': '{admin_token}'}),
+    ('gallery', 'POST', 'like', {}, {'imageId': '{image_id}'}, {'X-User-Token': '{admin_token}'}),
+    ('gallery', 'GET', 'list', {}, None, {}),
+    ('gallery', 'GET', 'list', {'userId': '2'}, None, {}),
+    ('gallery', 'GET', 'top', {}, None, {}),
+]
+ADMIN_HEADERS = {'X-Admin-Id': '1'}
+
+def fill(value, context: dict):
+    if isinstance(value, str):
+        return value.format(**context)
+    if isinstance(value, dict):
+        return {k: fill(v, context) for k, v in value.items()}
+    if isinstance(value, list):
+        return [fill(v, context) for v in value]
+    return value
+
+def invoke(handler, function: str, method: str, action: str, params: dict, body, headers: dict, context: dict):
+    '''Вызывает обработчик и возвращает ответ вместе с записью структурированного лога'''
+    headers = dict(ADMIN_HEADERS, **headers) if function == 'admin' else headers
+    event = {
+        'httpMethod': method,
+        'queryStringParameters': dict(fill(params, context), action=action),
+        'headers': fill(headers, context),
+        'body': json.dumps(fill(body, context), ensure_ascii=False) if body is not None else None
+    }
+    out = io.StringIO()
+    with redirect_stdout(out):
+        response = handler(event, None)
+    entries = [json.loads(line) for line in out.getvalue().splitlines() if line.startswith('{')]
+    return response, entries[-1] if entries else {}
+
+def plan_issues(function: str, action: str, plan: list) -> list:
+    issues = []
+    for index, line in enumerate(plan):
+        scan = SEQ_SCAN.search(line)
+        sort = SORT.match(line)
+        if scan and scan.group(1) in LARGE_TABLES:
+            issues.append(line.strip())
+        elif sort and int(sort.group(3)) > SORT_ROW_LIMIT:
+            top_rank = (
+                index > 0 and LIMIT.match(plan[index - 1])
+                and index + 1 < len(plan) and RANK_SORT_KEY.match(plan[index + 1])
+            )
+            if not top_rank:
+                issues.append(line.strip())
+    return issues
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True, help='DSN сервера, на котором можно создать одноразовую базу')
+    parser.add_argument('--database', default=f'rt_plans_{os.getpid()}')
+    parser.add_argument('--reuse', action='store_true', help='проверить уже заполненную --database')
+    parser.add_argument('--keep', action='store_true', help='не удалять базу после проверки')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--posts', type=int, default=200_000)
+    parser.add_argument('--comments', type=int, default=200_000)
+    parser.add_argument('--verbose', action='store_true', help='печатать планы всех запросов')
+    args = parser.parse_args()
+    drift = runtime_drift()
+    if drift:
+        print(f"runtime.py differs from backend/runtime.py in {', '.join(p.parent.name for p in drift)}; run python bench/sync_runtime.py")
+        return 1
+
+    os.environ.update({
+        'SLOW_QUERY_MS': '0',
+        'REQUEST_LOG': '1',
+        'RESPONSE_CACHE_MAX_BYTES': '0',
+        'PROFILE_CACHE_SIZE': '0',
+        'INVALIDATION_POLL_INTERVAL': '0',
+        'LIKE_FOLD_INTERVAL': '0',
+        'XP_FOLD_INTERVAL': '0'
+    })
+
+    failures = []
+    try:
+        if args.reuse:
+            dsn = psycopg2.extensions.make_dsn(args.dsn, dbname=args.database)
+        else:
+            dsn = create_database(args.dsn, args.database)
+            migrate_and_seed(dsn, args.users, args.posts, args.comments)
+        os.environ['DATABASE_URL'] = dsn
+        os.environ['DATABASE_REPLICA_URLS'] = psycopg2.extensions.make_dsn(dsn, options='-c default_transaction_read_only=on')
+
+        modules = {name: load_function(name)[0] for name in FUNCTIONS}
+        context = {'run': os.getpid()}
+        covered = set()
+        checked = set()
+        for function, method, action, params, body, headers in CASES:
+            if action == 'posts' and 'cursor' in params and 'posts_cursor' not in context:
+                continue
+            response, entry = invoke(modules[function].handler, function, method, action, params, body, headers, context)
+            covered.add((function, method, action))
+            if response['statusCode'] >= 500:
+                failures.append(f"{function} {action}: status {response['statusCode']} {entry.get('error', '')}")
+            if action == 'register':
+                payload = json.loads(response['body'])
+                context.update(token=payload['token'], user_id=payload['user']['id'])
+            if action == 'login' and json.loads(response['body'])['user']['admin_role']:
+                context['admin_token'] = json.loads(response['body'])['token']
+            if action == 'upload-metadata':
+                context['image_id'] = json.loads(response['body'])['image']['id']
+            if action == 'posts' and 'posts_cursor' not in context:
+                context['posts_cursor'] = json.loads(response['body'])['nextCursor']
+
+            for slow in entry.get('slowQueries', []):
+                if slow['query'] in checked:
+                    continue
+                checked.add(slow['query'])
+                issues = plan_issues(function, action, slow['plan'])
+                if args.verbose or issues:
+                    print(f"{function} {action}: {slow['query'][:120]}")
+                    print('    ' + '\n    '.join(slow['plan']))
+                failures.extend(f"{function} {action}: {issue} in {slow['query'][:80]}" for issue in issues)
+
+        for function, module in modules.items():
+            for (method, action), (_, public) in module.router.routes.items():
+                if not public and (function, method, action) not in covered:
+                    failures.append(f'{function} {method} {action}: no plan-check case')
+    finally:
+        if not args.keep and not args.reuse:
+            drop_database(args.dsn, args.database)
+
+    print(f'checked {len(checked)} statements')
+    for failure in failures:
+        print(f'PLAN {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
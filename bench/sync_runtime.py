@@ -0,0 +1,47 @@
+'''Синхронизация runtime.py облачных функций с каноническим backend/runtime.py.
+
+Каждая функция разворачивается из своей папки и импортирует собственную копию runtime.py,
+поэтому правки вносятся только в backend/runtime.py, а копии перезаписываются этим скриптом.
+
+    python bench/sync_runtime.py           # переписать копии
+    python bench/sync_runtime.py --check   # только сверить хеши
+
+Код выхода 1, если при --check какая-то копия расходится с каноническим файлом.
+'''
+import argparse
+import hashlib
+import sys
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent / 'backend'
+CANONICAL = BACKEND / 'runtime.py'
+
+def function_dirs() -> list:
+    return sorted(path.parent for path in BACKEND.glob('*/index.py'))
+
+def file_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest() if path.exists() else ''
+
+def runtime_drift() -> list:
+    '''Копии runtime.py, чей хеш не совпадает с каноническим'''
+    expected = file_hash(CANONICAL)
+    return [directory / 'runtime.py' for directory in function_dirs() if file_hash(directory / 'runtime.py') != expected]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='store_true', help='не переписывать копии, а завершиться с ошибкой при расхождении')
+    args = parser.parse_args()
+
+    drift = runtime_drift()
+    if args.check:
+        for path in drift:
+            print(f'DRIFT {path.relative_to(BACKEND.parent)} differs from backend/runtime.py; run python bench/sync_runtime.py')
+        return 1 if drift else 0
+    source = CANONICAL.read_bytes()
+    for path in drift:
+        path.write_bytes(source)
+        print(f'updated {path.relative_to(BACKEND.parent)}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
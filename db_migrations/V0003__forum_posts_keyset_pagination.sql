@@ -0,0 +1,7 @@
+-- Заполнение пустых дат создания, чтобы курсор (created_at, id) был однозначным
+UPDATE forum_posts SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE forum_posts ALTER COLUMN created_at SET NOT NULL;
+
+-- Составные индексы для постраничной выдачи постов без сортировки
+CREATE INDEX IF NOT EXISTS idx_forum_posts_created_id ON forum_posts(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_category_created_id ON forum_posts(category, created_at DESC, id DESC);
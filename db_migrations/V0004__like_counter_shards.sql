@@ -0,0 +1,9 @@
+-- Шарды счётчиков лайков: каждый лайк увеличивает случайный шард вместо строки поста,
+-- накопленные значения периодически сворачиваются в колонку likes целевой таблицы
+CREATE TABLE IF NOT EXISTS like_counter_shards (
+    target_type VARCHAR(20) NOT NULL,
+    target_id INT NOT NULL,
+    shard SMALLINT NOT NULL,
+    delta INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (target_type, target_id, shard)
+);
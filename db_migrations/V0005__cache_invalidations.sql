@@ -0,0 +1,10 @@
+-- Журнал инвалидаций кэшей: функции записывают изменённые ключи, тёплые контейнеры
+-- других функций периодически дочитывают журнал и сбрасывают свои кэши
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id BIGSERIAL PRIMARY KEY,
+    scope VARCHAR(50) NOT NULL,
+    key VARCHAR(100) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created ON cache_invalidations(created_at);
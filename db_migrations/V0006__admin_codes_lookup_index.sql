@@ -0,0 +1,2 @@
+-- Покрывающий индекс для проверки админ-кода: код и срок действия читаются без обращения к таблице
+CREATE INDEX IF NOT EXISTS idx_admin_codes_code_valid ON admin_codes(code, valid_date);
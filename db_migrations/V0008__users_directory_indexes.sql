@@ -0,0 +1,18 @@
+-- Ключи сортировки справочника пользователей не должны содержать NULL для keyset-пагинации
+UPDATE users SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+UPDATE users SET experience = 0 WHERE experience IS NULL;
+UPDATE users SET is_banned = FALSE WHERE is_banned IS NULL;
+UPDATE users SET is_muted = FALSE WHERE is_muted IS NULL;
+ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE users ALTER COLUMN experience SET NOT NULL;
+ALTER TABLE users ALTER COLUMN is_banned SET NOT NULL;
+ALTER TABLE users ALTER COLUMN is_muted SET NOT NULL;
+
+-- Индексы под сортировки и фильтры админского справочника
+CREATE INDEX IF NOT EXISTS idx_users_created_id ON users(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_experience_id ON users(experience DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users(username text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_users_faction_created_id ON users(faction_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_banned_created_id ON users(created_at DESC, id DESC) WHERE is_banned;
+CREATE INDEX IF NOT EXISTS idx_users_muted_created_id ON users(created_at DESC, id DESC) WHERE is_muted;
+CREATE INDEX IF NOT EXISTS idx_users_admins_created_id ON users(admin_role, created_at DESC, id DESC) WHERE admin_role IS NOT NULL;
@@ -0,0 +1,16 @@
+-- Поисковые векторы на русском: вычисляются при каждой записи строки, заголовок важнее текста
+ALTER TABLE forum_posts ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', COALESCE(title, '')), 'A') ||
+        setweight(to_tsvector('russian', COALESCE(content, '')), 'B')
+    ) STORED;
+
+ALTER TABLE forum_comments ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(content, ''))) STORED;
+
+-- Дата комментария участвует в выдаче поиска
+UPDATE forum_comments SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE forum_comments ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_forum_posts_search ON forum_posts USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_forum_comments_search ON forum_comments USING GIN (search_vector);
@@ -0,0 +1,15 @@
+-- Комментарии поста читаются в порядке создания: составной индекс отдаёт их без сортировки
+CREATE INDEX IF NOT EXISTS idx_forum_comments_post_created_id ON forum_comments(post_id, created_at, id);
+DROP INDEX IF EXISTS idx_forum_comments_post;
+
+-- Фильтр действующих админ-кодов по дате (ротация кода отзывает все действующие)
+CREATE INDEX IF NOT EXISTS idx_admin_codes_valid_date ON admin_codes(valid_date);
+
+-- Отзыв сессий пользователя при бане трогает только неотозванные сессии
+CREATE INDEX IF NOT EXISTS idx_sessions_user_active ON sessions(user_id) WHERE revoked_at IS NULL;
+
+-- Дублирует индекс ограничения UNIQUE(username)
+DROP INDEX IF EXISTS idx_users_username;
+
+-- Сортировка справочника по имени идёт по (username, id), как и keyset-курсор
+CREATE INDEX IF NOT EXISTS idx_users_username_id ON users(username, id);
@@ -0,0 +1,12 @@
+-- Ключ ленты новостей не должен содержать NULL для keyset-пагинации
+UPDATE news SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE news ALTER COLUMN created_at SET NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_news_created_id ON news(created_at DESC, id DESC);
+
+-- Готовые сериализованные страницы ленты; пересобираются при публикации новости
+CREATE TABLE IF NOT EXISTS news_feed_snapshots (
+    cursor VARCHAR(200) PRIMARY KEY,
+    etag VARCHAR(64) NOT NULL,
+    body TEXT NOT NULL,
+    built_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
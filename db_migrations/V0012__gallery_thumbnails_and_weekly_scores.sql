@@ -0,0 +1,30 @@
+-- Метаданные миниатюр для сетки галереи
+ALTER TABLE gallery ADD COLUMN IF NOT EXISTS thumbnail_url VARCHAR(500);
+ALTER TABLE gallery ADD COLUMN IF NOT EXISTS width INT;
+ALTER TABLE gallery ADD COLUMN IF NOT EXISTS height INT;
+
+-- Ключи keyset-пагинации и счётчик лайков не должны содержать NULL
+UPDATE gallery SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+UPDATE gallery SET likes = 0 WHERE likes IS NULL;
+ALTER TABLE gallery ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE gallery ALTER COLUMN likes SET NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_gallery_created_id ON gallery(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_gallery_user_created_id ON gallery(user_id, created_at DESC, id DESC);
+
+-- Один лайк от пользователя на изображение
+CREATE TABLE IF NOT EXISTS gallery_likes (
+    gallery_id INT NOT NULL REFERENCES gallery(id),
+    user_id INT NOT NULL REFERENCES users(id),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (gallery_id, user_id)
+);
+
+-- Очки популярности за неделю, пополняются при свёртке шардов лайков
+CREATE TABLE IF NOT EXISTS gallery_weekly_scores (
+    week_start DATE NOT NULL,
+    gallery_id INT NOT NULL REFERENCES gallery(id),
+    score INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (week_start, gallery_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_gallery_weekly_scores_rank ON gallery_weekly_scores(week_start, score DESC, gallery_id DESC);
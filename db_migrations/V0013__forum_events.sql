@@ -0,0 +1,15 @@
+-- Журнал изменений форума для доставки новых постов, комментариев и лайков без опроса ленты.
+-- tx — номер транзакции-автора: читатели идут по (tx, id) и берут только транзакции младше
+-- xmin своего снимка, поэтому событие, закоммиченное позже соседнего с большим id, не теряется
+CREATE TABLE IF NOT EXISTS forum_events (
+    id BIGSERIAL PRIMARY KEY,
+    tx BIGINT NOT NULL DEFAULT txid_current(),
+    kind VARCHAR(20) NOT NULL,
+    post_id INT NOT NULL,
+    data JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_forum_events_tx_id ON forum_events(tx, id);
+CREATE INDEX IF NOT EXISTS idx_forum_events_post_tx_id ON forum_events(post_id, tx, id);
+CREATE INDEX IF NOT EXISTS idx_forum_events_created ON forum_events(created_at);
@@ -0,0 +1,28 @@
+-- Денормализованные счётчики активности темы: ведутся в транзакции add-comment
+ALTER TABLE forum_posts ADD COLUMN IF NOT EXISTS comment_count INT NOT NULL DEFAULT 0;
+ALTER TABLE forum_posts ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMP;
+
+UPDATE forum_posts p
+SET comment_count = c.comments, last_activity_at = GREATEST(p.created_at, c.last_comment_at)
+FROM (
+    SELECT post_id, COUNT(*) as comments, MAX(created_at) as last_comment_at
+    FROM forum_comments
+    GROUP BY post_id
+) c
+WHERE c.post_id = p.id;
+UPDATE forum_posts SET last_activity_at = created_at WHERE last_activity_at IS NULL;
+ALTER TABLE forum_posts ALTER COLUMN last_activity_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE forum_posts ALTER COLUMN last_activity_at SET NOT NULL;
+
+-- «Горячий» рейтинг: логарифм вовлечённости плюс время создания. Время растёт монотонно, поэтому
+-- затухание получается без пересчёта: каждые 12.5 часов новизны весят как вовлечённость в 10 раз больше.
+-- Столбец пересчитывается при изменении likes и comment_count и читается по индексу
+ALTER TABLE forum_posts ADD COLUMN IF NOT EXISTS hot_score DOUBLE PRECISION
+    GENERATED ALWAYS AS (
+        log(GREATEST(COALESCE(likes, 0) + 2 * comment_count, 1)::float8) + date_part('epoch', created_at) / 45000
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_forum_posts_hot_id ON forum_posts(hot_score DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_category_hot_id ON forum_posts(category, hot_score DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_activity_id ON forum_posts(last_activity_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_category_activity_id ON forum_posts(category, last_activity_at DESC, id DESC);
@@ -0,0 +1,47 @@
+-- Пороги рангов: rank_level пересчитывается из experience при свёртке начислений
+CREATE TABLE IF NOT EXISTS rank_levels (
+    level INT PRIMARY KEY,
+    min_experience INT NOT NULL UNIQUE
+);
+
+INSERT INTO rank_levels (level, min_experience) VALUES
+    (1, 0), (2, 100), (3, 250), (4, 500), (5, 1000),
+    (6, 2000), (7, 3500), (8, 5500), (9, 8000), (10, 12000)
+ON CONFLICT (level) DO NOTHING;
+
+-- Буфер начислений опыта: активность дописывает строки, не блокируя строку пользователя;
+-- свёртка переносит суммы в users одним проходом
+CREATE TABLE IF NOT EXISTS experience_awards (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INT NOT NULL REFERENCES users(id),
+    amount INT NOT NULL,
+    reason VARCHAR(50) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Число игроков с данным опытом: width = 1 — точное значение, width = 100 — корзина по 100 очков.
+-- faction_id = 0 — общая таблица. Позиция игрока = 1 + сумма по корзинам выше + точные значения выше внутри
+-- своей корзины, то есть не больше сотни строк по первичному ключу. Игроки без опыта не учитываются
+CREATE TABLE IF NOT EXISTS leaderboard_counts (
+    faction_id INT NOT NULL,
+    width INT NOT NULL,
+    value INT NOT NULL,
+    users INT NOT NULL,
+    PRIMARY KEY (faction_id, width, value)
+);
+
+UPDATE users u
+SET rank_level = (SELECT MAX(r.level) FROM rank_levels r WHERE r.min_experience <= u.experience)
+WHERE u.rank_level IS DISTINCT FROM (SELECT MAX(r.level) FROM rank_levels r WHERE r.min_experience <= u.experience);
+
+INSERT INTO leaderboard_counts (faction_id, width, value, users)
+SELECT s.faction_id, w.width, u.experience / w.width, COUNT(*)
+FROM users u
+CROSS JOIN LATERAL (VALUES (0), (u.faction_id)) s(faction_id)
+CROSS JOIN (VALUES (1), (100)) w(width)
+WHERE u.experience > 0 AND s.faction_id IS NOT NULL
+GROUP BY 1, 2, 3
+ON CONFLICT (faction_id, width, value) DO NOTHING;
+
+-- Первые места фракции читаются по индексу без сортировки (общая таблица — idx_users_experience_id)
+CREATE INDEX IF NOT EXISTS idx_users_faction_experience_id ON users(faction_id, experience DESC, id DESC);
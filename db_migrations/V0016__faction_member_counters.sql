@@ -0,0 +1,18 @@
+-- Счётчики состава фракции: ведутся в тех же запросах, что меняют faction_id и is_banned
+-- (регистрация, назначение во фракцию, бан), поэтому обзор фракций не агрегирует users при чтении
+ALTER TABLE factions ADD COLUMN IF NOT EXISTS member_count INT NOT NULL DEFAULT 0;
+ALTER TABLE factions ADD COLUMN IF NOT EXISTS admin_count INT NOT NULL DEFAULT 0;
+ALTER TABLE factions ADD COLUMN IF NOT EXISTS banned_count INT NOT NULL DEFAULT 0;
+
+UPDATE factions f
+SET member_count = COALESCE(c.members, 0), admin_count = COALESCE(c.admins, 0), banned_count = COALESCE(c.banned, 0)
+FROM factions f2
+LEFT JOIN (
+    SELECT faction_id,
+           COUNT(*) as members,
+           COUNT(*) FILTER (WHERE admin_role IS NOT NULL) as admins,
+           COUNT(*) FILTER (WHERE is_banned) as banned
+    FROM users
+    GROUP BY faction_id
+) c ON c.faction_id = f2.id
+WHERE f2.id = f.id;
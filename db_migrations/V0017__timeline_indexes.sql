@@ -0,0 +1,9 @@
+-- Лента активности сливает посты, комментарии и новости по (created_at, id): каждый источник
+-- читается диапазоном индекса не дальше страницы — и в общей ленте, и в ленте одного пользователя
+CREATE INDEX IF NOT EXISTS idx_forum_comments_created_id ON forum_comments(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_forum_comments_user_created_id ON forum_comments(user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_news_author_created_id ON news(author_id, created_at DESC, id DESC);
+
+-- Префикс нового индекса по автору поста заменяет прежний индекс по user_id
+CREATE INDEX IF NOT EXISTS idx_forum_posts_user_created_id ON forum_posts(user_id, created_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_forum_posts_user;
@@ -0,0 +1,10 @@
+-- Общие токен-бакеты ограничения частоты записей: ключ — действие и клиент (пользователь, адрес, логин).
+-- Пополнение считается при списании по времени последнего обновления; бакеты, не тронутые сутки, удаляются.
+-- Состояние восстановимо, поэтому таблица не журналируется
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at);
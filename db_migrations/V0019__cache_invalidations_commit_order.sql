@@ -0,0 +1,6 @@
+-- id из последовательности выдаётся до коммита, поэтому строка с меньшим id может появиться после уже
+-- прочитанной с большим. Читатели журнала идут по (tx, id) и берут только транзакции младше xmin своего снимка,
+-- как и в forum_events
+ALTER TABLE cache_invalidations ADD COLUMN IF NOT EXISTS tx BIGINT NOT NULL DEFAULT txid_current();
+
+CREATE INDEX IF NOT EXISTS idx_cache_invalidations_tx_id ON cache_invalidations(tx, id);
@@ -0,0 +1,37 @@
+const LAST_WRITE_KEY = 'russian_town_last_write';
+// Совпадает с READ_YOUR_WRITES_WINDOW функций (по умолчанию 10 секунд)
+const READ_YOUR_WRITES_WINDOW_MS = 10_000;
+
+interface LastWrite {
+  stamp: string;
+  until: number;
+}
+
+function readLastWrite(): LastWrite | null {
+  const raw = localStorage.getItem(LAST_WRITE_KEY);
+  if (!raw) return null;
+  try {
+    const lastWrite: LastWrite = JSON.parse(raw);
+    if (lastWrite.until > Date.now()) return lastWrite;
+  } catch {
+    // Повреждённая запись просто удаляется
+  }
+  localStorage.removeItem(LAST_WRITE_KEY);
+  return null;
+}
+
+// Сервер отдаёт X-Last-Write в ответ на запись; пока окно не истекло, чтения с ним идут на основную базу.
+// После окна заголовок не отправляется, чтобы обычные GET не требовали CORS preflight
+export async function apiFetch(url: string, init: RequestInit = {}): Promise<Response> {
+  const headers = new Headers(init.headers);
+  const lastWrite = readLastWrite();
+  if (lastWrite) headers.set('X-Last-Write', lastWrite.stamp);
+  const response = await fetch(url, { ...init, headers });
+  const stamp = response.headers.get('X-Last-Write');
+  if (stamp) {
+    // Окно отсчитывается по часам браузера от получения ответа, чтобы расхождение часов с сервером не мешало
+    const until = Date.now() + READ_YOUR_WRITES_WINDOW_MS;
+    localStorage.setItem(LAST_WRITE_KEY, JSON.stringify({ stamp, until }));
+  }
+  return response;
+}
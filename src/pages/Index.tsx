@@ -9,6 +9,7 @@ import { Label } from '@/components/ui/label';
 import { Textarea } from '@/components/ui/textarea';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
+import { apiFetch } from '@/lib/api';
 
 const API_URLS = {
   auth: 'https://functions.poehali.dev/62fd37d2-dd57-4aff-917e-f6e0383e053a',
@@ -34,6 +35,7 @@ interface Faction {
   description: string;
   color: string;
   general_name?: string;
+  member_count?: number;
 }
 
 interface ForumPost {
@@ -43,6 +45,7 @@ interface ForumPost {
   username: string;
   admin_role?: string;
   likes: number;
+  comment_count?: number;
   category: string;
 }
 
@@ -72,9 +75,27 @@ export default function Index() {
     loadForumPosts();
   }, []);
 
+  useEffect(() => {
+    const events = new EventSource(`${API_URLS.forum}/?action=events`);
+    events.addEventListener('post', (e) => {
+      const post = JSON.parse((e as MessageEvent).data).data as ForumPost;
+      setForumPosts(posts => posts.some(p => p.id === post.id) ? posts : [post, ...posts]);
+    });
+    events.addEventListener('like', (e) => {
+      const { post_id, likes } = JSON.parse((e as MessageEvent).data).data;
+      setForumPosts(posts => posts.map(p => p.id === post_id ? { ...p, likes } : p));
+    });
+    events.addEventListener('comment', (e) => {
+      const { post_id, comment_count } = JSON.parse((e as MessageEvent).data).data;
+      setForumPosts(posts => posts.map(p => p.id === post_id ? { ...p, comment_count } : p));
+    });
+    events.addEventListener('reset', () => loadForumPosts());
+    return () => events.close();
+  }, []);
+
   const loadFactions = async () => {
     try {
-      const response = await fetch(`${API_URLS.admin}/?action=factions`, {
+      const response = await apiFetch(`${API_URLS.admin}/?action=factions`, {
         headers: { 'X-Admin-Id': '1' }
       });
       const data = await response.json();
@@ -86,7 +107,7 @@ export default function Index() {
 
   const loadForumPosts = async () => {
     try {
-      const response = await fetch(`${API_URLS.forum}/?action=posts`);
+      const response = await apiFetch(`${API_URLS.forum}/?action=posts`);
       const data = await response.json();
       if (data.posts) setForumPosts(data.posts);
     } catch (error) {
@@ -97,7 +118,7 @@ export default function Index() {
   const handleAuth = async () => {
     try {
       const action = isLogin ? 'login' : 'register';
-      const response = await fetch(`${API_URLS.auth}/?action=${action}`, {
+      const response = await apiFetch(`${API_URLS.auth}/?action=${action}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ username, password })
@@ -130,9 +151,12 @@ export default function Index() {
     if (!user) return;
     
     try {
-      const response = await fetch(`${API_URLS.forum}/?action=create-post`, {
+      const response = await apiFetch(`${API_URLS.forum}/?action=create-post`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: {
+          'Content-Type': 'application/json',
+          'X-User-Token': localStorage.getItem('russian_town_token') || ''
+        },
         body: JSON.stringify({
           userId: user.id,
           title: postTitle,
@@ -157,9 +181,9 @@ export default function Index() {
     if (!user?.admin_role) return;
     
     try {
-      const response = await fetch(`${API_URLS.admin}/?action=users`, {
+      const response = await apiFetch(`${API_URLS.admin}/?action=users`, {
         headers: { 
-          'X-Admin-Id': user.id.toString(),
+          'X-User-Token': localStorage.getItem('russian_town_token') || '',
           'X-Admin-Code': adminCode
         }
       });
@@ -275,6 +299,10 @@ export default function Index() {
                         <span>Генерал: <strong>{faction.general_name}</strong></span>
                       </div>
                     )}
+                    <div className="flex items-center gap-2 text-sm text-muted-foreground mt-1">
+                      <Icon name="Users" size={16} />
+                      <span>Участников: {faction.member_count ?? 0}</span>
+                    </div>
                   </Card>
                 ))}
               </div>
@@ -412,7 +440,7 @@ export default function Index() {
                           </button>
                           <button className="flex items-center gap-1 hover:text-primary transition-colors">
                             <Icon name="MessageCircle" size={16} />
-                            <span>Ответить</span>
+                            <span>{post.comment_count ? post.comment_count : 'Ответить'}</span>
                           </button>
                         </div>
                       </div>